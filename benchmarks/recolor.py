@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+"""
+Compares the band based recoloring of sprite maps and images (`_recolor()`)
+with the per pixel loop it replaced, on a 2000x2000 RGBA image:
+
+    PYTHONPATH=. python benchmarks/recolor.py
+"""
+import random
+import time
+
+from PIL import Image
+
+from scss import _recolor
+
+
+def loop_recolor(image, src_color, dst_color):
+    pixdata = image.load()
+    for y in xrange(image.size[1]):
+        for x in xrange(image.size[0]):
+            if pixdata[x, y][:3] == src_color:
+                pixdata[x, y] = tuple(dst_color + [ pixdata[x, y][3] ])
+    return image
+
+
+def main(size=2000):
+    random.seed(0)
+    image = Image.new('RGBA', (size, size))
+    pixdata = image.load()
+    colors = [ (0, 0, 0), (10, 20, 30), (255, 255, 255) ]
+    for y in xrange(size):
+        for x in xrange(0, size, 7):
+            pixdata[x, y] = random.choice(colors) + (random.randint(0, 255),)
+
+    for src_color, dst_color in [ ((0, 0, 0), [255, 0, 0]), ((10, 20, 30), [1, 2, 3]), ((10.5, 0, 0), [1, 2, 3]) ]:
+        t = time.time()
+        expected = loop_recolor(image.copy(), src_color, dst_color)
+        loop_time = time.time() - t
+        t = time.time()
+        got = _recolor(image.copy(), src_color, dst_color)
+        bands_time = time.time() - t
+        print '%-14s identical: %-5s loop: %.2fs  bands: %.3fs' % (src_color, expected.tobytes() == got.tobytes(), loop_time, bands_time)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""
+Times a stylesheet with several sprite maps built inline and on a pool of
+sprite processes (4 maps of 80 400x400 icons each, smart layout):
+
+    PYTHONPATH=. python benchmarks/sprites.py [processes]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+import scss
+
+
+def main(processes=4, maps='abcd', count=80):
+    tmp = tempfile.mkdtemp()
+    try:
+        for d in maps:
+            os.makedirs(os.path.join(tmp, d))
+            for i in range(count):
+                Image.new('RGBA', (400, 400), (i, ord(d), 0, 255)).save(os.path.join(tmp, d, 'i%02d.png' % i))
+        scss.STATIC_ROOT = tmp + '/'
+        source = ''.join('$%s: sprite-map("%s/*.png", $layout: smart); .%s { background: $%s; }' % (d, d, d, d) for d in maps)
+        for n in (0, processes):
+            assets = os.path.join(tmp, 'assets-%d' % n)
+            os.makedirs(assets)
+            scss.ASSETS_ROOT = assets + '/'
+            scss.SPRITE_PROCESSES = n
+            t = time.time()
+            scss.Scss().compile(source)
+            print '%d sprite processes: %.2fs' % (n, time.time() - t)
+        scss.close_sprite_pool()
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main(*[ int(a) for a in sys.argv[1:2] ])
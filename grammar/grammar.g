@@ -1,6 +1,5 @@
 # python yapps2.py grammar.g grammar.py
-def _reorder_list(lst):
-    return dict((i if isinstance(k, int) else k, v) for i, (k, v) in enumerate(sorted(lst.items())))
+import operator
 _units = ['em', 'ex', 'px', 'cm', 'mm', 'in', 'pt', 'pc', 'deg', 'rad'
           'grad', 'ms', 's', 'hz', 'khz', '%']
 ParserValue = lambda s: s
@@ -9,8 +8,10 @@ StringValue = lambda s: s
 QuotedStringValue = lambda s: s
 BooleanValue = lambda s: bool(s)
 ColorValue = lambda s: s
-ListValue = lambda s: s
+ListValue = lambda s, sep=None: s
 _inv = lambda s: s
+_op = lambda op, a, b: op(a, b)
+_units_op = lambda v, u, R: v
 def interpolate(v, R):
     return v
 def call(fn, args, R, function=True):
@@ -82,15 +83,15 @@ parser Calculator:
                               )*                            {{ return v }}
     rule a_expr<<R>>:       m_expr<<R>>                     {{ v = m_expr }}
                               (
-                                  ADD m_expr<<R>>           {{ v = v + m_expr }}
+                                  ADD m_expr<<R>>           {{ v = _op(operator.__add__, v, m_expr) }}
                                   |
-                                  SUB m_expr<<R>>           {{ v = v - m_expr }}
+                                  SUB m_expr<<R>>           {{ v = _op(operator.__sub__, v, m_expr) }}
                               )*                            {{ return v }}
     rule m_expr<<R>>:       u_expr<<R>>                     {{ v = u_expr }}
                               (
-                                  MUL u_expr<<R>>           {{ v = v * u_expr }}
+                                  MUL u_expr<<R>>           {{ v = _op(operator.__mul__, v, u_expr) }}
                                   |
-                                  DIV u_expr<<R>>           {{ v = v / u_expr }}
+                                  DIV u_expr<<R>>           {{ v = _op(operator.__div__, v, u_expr) }}
                               )*                            {{ return v }}
     rule u_expr<<R>>:       SIGN u_expr<<R>>                {{ return _inv('-', u_expr) }}
                               |
@@ -98,7 +99,7 @@ parser Calculator:
                               |
                               atom<<R>>                     {{ v = atom }}
                               [
-                                  UNITS                     {{ v = call(UNITS, ListValue(ParserValue({ 0: v, 1: UNITS })), R, False) }}
+                                  UNITS                     {{ v = _units_op(v, UNITS, R) }}
                               ]                             {{ return v }}
     rule atom<<R>>:         LPAR expr_lst<<R>> RPAR         {{ return expr_lst.first() if len(expr_lst) == 1 else expr_lst }}
                               |
@@ -120,26 +121,26 @@ parser Calculator:
                               COLOR                         {{ return ColorValue(ParserValue(COLOR)) }}
                               |
                               VAR                           {{ return interpolate(VAR, R) }}
-    rule expr_lst<<R>>:                                     {{ n = None }}
+    rule expr_lst<<R>>:                                     {{ n = sep = None }}
                               [
                                   VAR [
                                       ":"                   {{ n = VAR }}
                                   ]                         {{ else: self._rewind() }}
                               ]
-                              expr_slst<<R>>                {{ v = { n or 0: expr_slst } }}
+                              expr_slst<<R>>                {{ v = [(n, expr_slst)] }}
                               (                             {{ n = None }}
-                                  COMMA                     {{ v['_'] = COMMA }}
+                                  COMMA                     {{ sep = COMMA }}
                                   [
                                       VAR [
                                           ":"               {{ n = VAR }}
                                       ]                     {{ else: self._rewind() }}
                                   ]
-                                  expr_slst<<R>>            {{ v[n or len(v)] = expr_slst }}
-                              )*                            {{ return ListValue(ParserValue(v)) }}
-    rule expr_slst<<R>>:    expr<<R>>                       {{ v = { 0: expr } }}
+                                  expr_slst<<R>>            {{ v.append((n, expr_slst)) }}
+                              )*                            {{ return ListValue(ParserValue(v), sep) }}
+    rule expr_slst<<R>>:    expr<<R>>                       {{ v = [expr] }}
                               (
-                                  expr<<R>>                 {{ v[len(v)] = expr }}
-                              )*                            {{ return ListValue(ParserValue(v)) if len(v) > 1 else v[0] }}
+                                  expr<<R>>                 {{ v.append(expr) }}
+                              )*                            {{ return ListValue(v) if len(v) > 1 else v[0] }}
 %%
     expr_lst_rsts_ = None
 
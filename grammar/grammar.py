@@ -1,6 +1,5 @@
 # python yapps2.py grammar.g grammar.py
-def _reorder_list(lst):
-    return dict((i if isinstance(k, int) else k, v) for i, (k, v) in enumerate(sorted(lst.items())))
+import operator
 _units = ['em', 'ex', 'px', 'cm', 'mm', 'in', 'pt', 'pc', 'deg', 'rad'
           'grad', 'ms', 's', 'hz', 'khz', '%']
 ParserValue = lambda s: s
@@ -9,8 +8,10 @@ StringValue = lambda s: s
 QuotedStringValue = lambda s: s
 BooleanValue = lambda s: bool(s)
 ColorValue = lambda s: s
-ListValue = lambda s: s
+ListValue = lambda s, sep=None: s
 _inv = lambda s: s
+_op = lambda op, a, b: op(a, b)
+_units_op = lambda v, u, R: v
 def interpolate(v, R):
     return v
 def call(fn, args, R, function=True):
@@ -142,11 +143,11 @@ class Calculator(Parser):
             if _token_ == 'ADD':
                 ADD = self._scan('ADD')
                 m_expr = self.m_expr(R)
-                v = v + m_expr
+                v = _op(operator.__add__, v, m_expr)
             else:# == 'SUB'
                 SUB = self._scan('SUB')
                 m_expr = self.m_expr(R)
-                v = v - m_expr
+                v = _op(operator.__sub__, v, m_expr)
         return v
 
     def m_expr(self, R):
@@ -157,11 +158,11 @@ class Calculator(Parser):
             if _token_ == 'MUL':
                 MUL = self._scan('MUL')
                 u_expr = self.u_expr(R)
-                v = v * u_expr
+                v = _op(operator.__mul__, v, u_expr)
             else:# == 'DIV'
                 DIV = self._scan('DIV')
                 u_expr = self.u_expr(R)
-                v = v / u_expr
+                v = _op(operator.__div__, v, u_expr)
         return v
 
     def u_expr(self, R):
@@ -179,7 +180,7 @@ class Calculator(Parser):
             v = atom
             if self._peek(self.u_expr_rsts_) == 'UNITS':
                 UNITS = self._scan('UNITS')
-                v = call(UNITS, ListValue(ParserValue({ 0: v, 1: UNITS })), R, False)
+                v = _units_op(v, UNITS, R)
             return v
 
     def atom(self, R):
@@ -221,7 +222,7 @@ class Calculator(Parser):
             return interpolate(VAR, R)
 
     def expr_lst(self, R):
-        n = None
+        n = sep = None
         if self._peek(self.expr_lst_rsts) == 'VAR':
             VAR = self._scan('VAR')
             if self._peek(self.expr_lst_rsts_) == '":"':
@@ -229,11 +230,11 @@ class Calculator(Parser):
                 n = VAR
             else: self._rewind()
         expr_slst = self.expr_slst(R)
-        v = { n or 0: expr_slst }
+        v = [(n, expr_slst)]
         while self._peek(self.expr_lst_rsts__) == 'COMMA':
             n = None
             COMMA = self._scan('COMMA')
-            v['_'] = COMMA
+            sep = COMMA
             if self._peek(self.expr_lst_rsts) == 'VAR':
                 VAR = self._scan('VAR')
                 if self._peek(self.expr_lst_rsts_) == '":"':
@@ -241,16 +242,16 @@ class Calculator(Parser):
                     n = VAR
                 else: self._rewind()
             expr_slst = self.expr_slst(R)
-            v[n or len(v)] = expr_slst
-        return ListValue(ParserValue(v))
+            v.append((n, expr_slst))
+        return ListValue(ParserValue(v), sep)
 
     def expr_slst(self, R):
         expr = self.expr(R)
-        v = { 0: expr }
+        v = [expr]
         while self._peek(self.expr_slst_rsts) not in self.expr_lst_rsts__:
             expr = self.expr(R)
-            v[len(v)] = expr
-        return ListValue(ParserValue(v)) if len(v) > 1 else v[0]
+            v.append(expr)
+        return ListValue(v) if len(v) > 1 else v[0]
 
     not_test_rsts_ = set(['AND', 'LPAR', 'QSTR', 'END', 'COLOR', 'INV', 'SIGN', 'VAR', 'ADD', 'NUM', 'COMMA', 'FNCT', 'STR', 'NOT', 'BOOL', 'ID', 'RPAR', 'OR'])
     m_expr_chks = set(['MUL', 'DIV'])
@@ -56,6 +56,8 @@ STATIC_URL = '/static/'
 ASSETS_URL = '/static/assets/'
 VERBOSITY = 1
 DEBUG = 0
+# Processes to build sprite images in parallel (0 builds them right away):
+SPRITE_PROCESSES = 0
 ################################################################################
 
 import logging
@@ -69,7 +71,8 @@ import re
 import sys
 import time
 import textwrap
-from collections import deque
+import fnmatch
+from collections import deque, OrderedDict
 
 profiling = {}
 
@@ -313,13 +316,36 @@ _default_scss_vars = {
     'bgc:': 'background-color:',
 }
 
+# Output styles as the (compress, verbosity) used to render them:
+_output_styles = {
+    'compressed': (1, None),
+    'expanded': (0, None),
+    'debug': (0, 2),
+}
+
 _default_scss_opts = {
     'verbosity': VERBOSITY,
     'compress': 1,
     'compress_short_colors': 1, # Converts things like #RRGGBB to #RGB
     'compress_reverse_colors': 1, # Gets the shortest name of all for colors
+    'compress_rules': 0, # Merges rules, drops overridden properties and shortens numbers
+    'group_media': 0, # Puts rules with the same media queries together in a single @media block
     'short_colors': 0, # Converts things like #RRGGBB to #RGB
     'reverse_colors': 0, # Gets the shortest name of all for colors
+    'import_once': 0, # Files are only imported once, later imports just bring in their definitions
+    'browsers': '', # Target browsers (i.e. "chrome firefox ie") or vendor prefixes, only their prefixes are generated
+}
+
+# Vendor prefixes needed by each browser ("browsers" option):
+_browser_prefixes = {
+    'chrome': ('webkit',),
+    'safari': ('webkit',),
+    'ios': ('webkit',),
+    'android': ('webkit',),
+    'firefox': ('moz',),
+    'opera': ('o', 'webkit'),
+    'ie': ('ms', 'svg', 'pie'),
+    'konqueror': ('khtml',),
 }
 
 _short_color_re = re.compile(r'(?<!\w)#([a-f0-9])\1([a-f0-9])\2([a-f0-9])\3\b', re.IGNORECASE)
@@ -352,13 +378,31 @@ _sl_comment_re = re.compile(r'(?<!\w{2}:)\/\/.*')
 # and all argument types must match.
 _zero_units_re = re.compile(r'\b0(' + '|'.join([ re.escape(u) for u in _units if u != '%' ]) + r')(?!\w)', re.IGNORECASE)
 _zero_re = re.compile(r'\b0\.(?=\d)')
+_quoted_or_url_re = re.compile(r'''("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|url\([^)]*\))''', re.IGNORECASE)
+_vendor_value_re = re.compile(r'(?<![-\w])-(?:webkit|moz|ms|o|khtml)-')
+_vendor_pseudo_re = re.compile(r'::?-(?:webkit|moz|ms|o|khtml)-')
 
 _interpolate_re = re.compile(r'(#\{\s*)?(\$[-\w]+)(?(1)\s*\})')
+_function_impure_re = re.compile(r'@(?!(?:return|if|else|for|each)(?![-\w]))')
+_function_call_re = re.compile(r'([-a-zA-Z_][-a-zA-Z0-9_]*)(?=\()')
+_function_vars_re = re.compile(r'\$[-\w]+')
+_mixin_impure_re = re.compile(r'@(?!(?:if|else|for|each|include|extend)(?![-\w]))|(?:^|(?<=[;{}]))\s*=')
+_mixin_include_re = re.compile(r'(?:@include\s+|(?:^|(?<=[;{}]))\s*\+)([-a-zA-Z_][-a-zA-Z0-9_]*)')
 _spaces_re = re.compile(r'\s+')
+_combinator_re = re.compile(r'\s*([>+~])\s*|\s+')
+_simple_selector_re = re.compile(r'\*|[-\w]+|[#.%][-\w]+|\[[^\]]*\]|::?[-\w]+(?:\([^)]*\))?')
+_pseudo_element_re = re.compile(r'::|:(?:before|after|first-line|first-letter)$', re.IGNORECASE)
+_html_tag_re = re.compile(r'<([a-zA-Z][-\w]*)')
+_html_template_re = re.compile(r'\{\{.*?\}\}|\{%.*?%\}', re.DOTALL)
+_html_attr_re = re.compile(r'''(?<![-\w])(class|id)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''', re.IGNORECASE)
 _expand_rules_space_re = re.compile(r'\s*{')
 _collapse_properties_space_re = re.compile(r'([:#])\s*{')
 
 _strings_re = re.compile(r'([\'"]).*?\1')
+# Sass constructs (or things which are too hard to tell apart from them) not found in plain CSS:
+_sass_code_re = re.compile(r'[$&]|#\{|//|@(?!media\s|font-face\b|page\b)|\sextends\s|(?:^|[{};])\s*[+=]')
+_plain_math_re = re.compile(r'[*+]|\s-\s|(?<![-\w])\(')
+_plain_css_re = re.compile(r'''((?:"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|[^{};"'])*)([{};]|$)''')
 _blocks_re = re.compile(r'[{},;()\'"]|\n+|$')
 
 _prop_split_re = re.compile(r'[:=]')
@@ -441,6 +485,85 @@ def spawn_rule(rule=None, **kwargs):
         rule[RULE_VARS[k.upper()]] = v
     return rule
 
+def _media_key(media):
+    """
+    Returns the unique media queries in a rule's MEDIA, in order
+    """
+    seen = set()
+    return tuple(m for m in media if not (m in seen or seen.add(m)))
+
+def _property_family(prop):
+    """
+    Returns the family of a property: shorthands and their longhands (i.e.
+    margin and margin-left) are the same family, vendor prefixes aside
+    """
+    return _vendor_value_re.sub('', prop).split('-', 1)[0]
+
+_prune_selectors_size = 200
+_extended_selectors_size = 2000
+
+def _parse_selector(selector):
+    """
+    Parses a selector into its specificity and a sequence of (combinator,
+    compound) pairs, a compound being the element, the set of the other
+    simple selectors and the pseudo-elements. Returns None for selectors
+    it doesn't understand.
+    """
+    parts = _combinator_re.split(selector.strip())
+    combinators = [ None ] + [ c or ' ' for c in parts[1::2] ]
+    ids = classes = elements = 0
+    sequence = []
+    for combinator, compound in zip(combinators, parts[::2]):
+        simples = _simple_selector_re.findall(compound)
+        if not compound or ''.join(simples) != compound:
+            return None
+        element = None
+        if simples[0] == '*' or simples[0][0] not in '#.%[:':
+            element = simples.pop(0).lower()
+            if element != '*':
+                elements += 1
+        others = set()
+        pseudos = []
+        for simple in simples:
+            if simple == '*' or simple[0] not in '#.%[:':
+                return None
+            if simple[0] == '#':
+                ids += 1
+            elif _pseudo_element_re.match(simple):
+                elements += 1
+                pseudos.append(simple)
+                continue
+            else:
+                classes += 1
+            if pseudos:
+                pseudos.append(simple)
+            else:
+                others.add(simple)
+        sequence.append((combinator, (element, frozenset(others), tuple(pseudos))))
+    return (ids, classes, elements), tuple(sequence)
+
+def _is_superselector(sup, sub, i=None, j=None):
+    """
+    Checks if the parsed selector `sup` matches every element `sub` matches
+    (only the simpler cases are detected)
+    """
+    if i is None:
+        i, j = len(sup) - 1, len(sub) - 1
+    combinator, (element, others, pseudos) = sup[i]
+    _element, _others, _pseudos = sub[j][1]
+    if element not in (None, '*', _element) or not others <= _others or pseudos != _pseudos:
+        return False
+    if combinator is None:
+        return True
+    if combinator == ' ':
+        # any ancestor of the sub-selector's compound can match:
+        while j > 0 and sub[j][0] in (' ', '>'):
+            j -= 1
+            if _is_superselector(sup, sub, i - 1, j):
+                return True
+        return False
+    return sub[j][0] == combinator and _is_superselector(sup, sub, i - 1, j - 1)
+
 def print_timing(level=0):
     def _print_timing(func):
         if VERBOSITY:
@@ -500,16 +623,23 @@ class Scss(object):
                 if path_param not in self.load_paths:
                     self.load_paths.append(path_param)
 
-        self.scss_files = {}
+        self.scss_files = OrderedDict() # compiled in the order they're added
         self.scss_vars = _default_scss_vars.copy()
         self.scss_opts = _default_scss_opts.copy()
+        self._base = None
+        self._functions_generation = 0
+        # Kept between compilations (their keys hold all they depend on):
+        self._calculations = {}
+        self._function_names = set()
+        self._loaded = {}
+        self._used = None
         self.reset()
 
     def clean(self):
         self.children = deque()
         self.rules = []
         self._rules = {}
-        self.parts = {}
+        self.parts = OrderedDict() # (ordered, so @extend results don't depend on hashing)
 
     def reset(self, input_scss=None):
         # Initialize
@@ -519,10 +649,36 @@ class Scss(object):
         self._scss_files = self.scss_files.copy()
 
         self._contexts = {}
-        self._replaces = {}
+        if self._base is None:
+            self._replaces = {}
+            self._imports = {}
+        else:
+            self._replaces, self._imports = (d.copy() for d in self._base)
+        # Generations keep growing so functions shared by several
+        # compilations never see stale purity verdicts:
+        self._functions_generation += 1
+        self._includes = {}
+        self._unprepared = {}
+        self._variables_only = False
+        self._extended = set()
 
         self.clean()
 
+    def freeze(self, input_scss=None):
+        """
+        Compiles a preamble (options, variables, mixins, functions and
+        framework imports) and keeps the resulting environment as the base
+        every later compilation starts from, so it doesn't have to be
+        evaluated again. CSS emitted by the preamble is discarded.
+        """
+        self.Compilation(input_scss)
+        for mixin, context in self._unprepared.values():
+            self._prepare_mixin(mixin)
+        self.scss_vars = self._scss_vars
+        self.scss_opts = self._scss_opts
+        self._base = (self._replaces, self._imports)
+        self.reset()
+
     def longest_common_prefix(self, seq1, seq2):
         start = 0
         common = 0
@@ -686,6 +842,48 @@ class Scss(object):
             return ','.join(sorted(selectors)) + ' extends ' + '&'.join(sorted(parents))
         return ','.join(sorted(selectors))
 
+    def prune_selectors(self, _selectors):
+        """
+        Removes from a normalized selectors string the selectors that are
+        duplicates of (i.e. `.a.b` and `.b.a`) or subsumed by (i.e. `.a > .b`
+        by `.a .b`) another selector in the string that is at least as
+        specific, so the cascade is left untouched.
+        """
+        selectors, _, parents = _selectors.partition(' extends ')
+        selectors = selectors.split(',')
+        if len(selectors) < 2:
+            return _selectors
+        # Comparing every pair doesn't scale to the lists a heavy use of
+        # @extend can produce, past some size only duplicates are removed:
+        pairwise = len(selectors) <= _prune_selectors_size
+        removed = set()
+        seen = set()
+        kept = []
+        for i, selector in enumerate(selectors):
+            parsed = _parse_selector(selector)
+            if parsed is None:
+                continue
+            specificity, sequence = parsed
+            if sequence in seen:
+                removed.add(i)
+                continue
+            seen.add(sequence)
+            if pairwise:
+                if any(s >= specificity and _is_superselector(q, sequence) for j, s, q in kept):
+                    removed.add(i)
+                    continue
+                for j, s, q in kept:
+                    if specificity >= s and _is_superselector(sequence, q):
+                        removed.add(j)
+                kept = [ k for k in kept if k[0] not in removed ]
+                kept.append((i, specificity, sequence))
+        if not removed:
+            return _selectors
+        selectors = ','.join(s for i, s in enumerate(selectors) if i not in removed)
+        if parents:
+            return selectors + ' extends ' + parents
+        return selectors
+
     def apply_vars(self, cont, context, options=None, rule=None, _dequote=False):
         if '$' in cont:
             if cont in context:
@@ -693,6 +891,8 @@ class Scss(object):
                 # flatten the interpolation and use it:
                 while cont in context:
                     _cont = context[cont]
+                    if isinstance(_cont, Thunk):
+                        _cont = _cont.value
                     if _cont == cont:
                         break
                     cont = _cont
@@ -709,6 +909,14 @@ class Scss(object):
                 # Interpolate variables:
                 def _av(m):
                     v = flat_context.get(m.group(2))
+                    # Lazy values are only evaluated when actually used:
+                    while isinstance(v, Thunk):
+                        v = v.value
+                        while v in context:
+                            _v = context[v]
+                            if _v == v:
+                                break
+                            v = _v
                     if v:
                         v = to_str(v)
                         if _dequote and m.group(1):
@@ -739,32 +947,101 @@ class Scss(object):
         if input_scss is not None:
             self._scss_files = { 'string': input_scss }
 
-        # Compile
-        for fileid, str in self._scss_files.iteritems():
-            self._scss_files[fileid] = self.parse_scss_string(fileid, str)
+        plain = [ (fileid, self.plain_css(str)) for fileid, str in self._scss_files.iteritems() ]
+        if all(rules is not None for fileid, rules in plain):
+            # Plain CSS goes straight to the output:
+            for fileid, rules in plain:
+                for selectors, media, properties in rules:
+                    rule = spawn_rule(fileid=fileid, position=len(self.rules), context=self._scss_vars, options=self._scss_opts, selectors=selectors, properties=properties, file=fileid, media=media and [ media ])
+                    self.rules.append(rule)
+        else:
+            # Compile
+            for fileid, str in self._scss_files.iteritems():
+                self._scss_files[fileid] = self.parse_scss_string(fileid, str)
 
-        # this will manage rule: child objects inside of a node
-        self.parse_children()
+            # this will manage rule: child objects inside of a node
+            self.parse_children()
 
-        # this will manage rule: ' extends '
-        self.parse_extends()
+            # this will manage rule: ' extends '
+            self.parse_extends()
 
-        # this will manage the order of the rules
-        self.manage_order()
+            # this will manage the order of the rules
+            self.manage_order()
 
         self.parse_properties()
 
+        final_cont = self.render()
+        wait_sprites()
+        return final_cont
+    compile = Compilation
+
+    def render(self, compress=None, verbosity=None):
+        """
+        Generates the final CSS for the last compilation, optionally using a
+        different `compress` or `verbosity` from the ones in the options.
+        """
         final_cont = ''
         for fileid in self.css_files:
             if fileid != 'string':
                 final_cont += '/* Generated from: ' + fileid + ' */\n'
-            fcont = self.create_css(fileid)
+            fcont = self.create_css(fileid, compress, verbosity)
             final_cont += fcont
 
-        final_cont = self.post_process(final_cont)
+        final_cont = self.post_process(final_cont, compress)
 
         return final_cont
-    compile = Compilation
+
+    def compile_variables(self, input_scss=None):
+        """
+        Only evaluates variables and functions (skipping nested rules, which
+        can't change global variables, @extend and the CSS generation) and
+        returns the global variables as values.
+        """
+        self.reset()
+
+        if input_scss is not None:
+            self._scss_files = { 'string': input_scss }
+
+        for fileid, str in self._scss_files.iteritems():
+            self._scss_files[fileid] = self.parse_scss_string(fileid, str)
+
+        self._variables_only = True
+        try:
+            self.parse_children()
+        finally:
+            self._variables_only = False
+
+        wait_sprites()
+
+        rule = spawn_rule(context=self._scss_vars, options=self._scss_opts)
+        return dict((k, interpolate(k, rule)) for k in self._scss_vars if k.startswith('$') and not k.startswith('$__'))
+
+    def compile_styles(self, input_scss=None, styles=('compressed', 'expanded')):
+        """
+        Compiles once and returns a dict with the output for each of the
+        given `styles` ('compressed', 'expanded' and 'debug', which is
+        expanded output annotated with the files and variables of rules).
+        """
+        self.Compilation(input_scss)
+        return dict((style, self.render(*_output_styles[style])) for style in styles)
+
+    def compile_variants(self, input_scss, variants):
+        """
+        Compiles `input_scss` once for every dict of variables in `variants`
+        (e.g. themes which only differ in a few variables), returning the list
+        of results. Every variant is still a full compilation; only the
+        preprocessed source and the memo of calculated expressions are reused.
+        """
+        scss_vars = self.scss_vars
+        results = []
+        try:
+            for variables in variants:
+                self.scss_vars = scss_vars.copy()
+                self.scss_vars.update(variables)
+                results.append(self.Compilation(input_scss))
+        finally:
+            self.scss_vars = scss_vars
+        return results
 
     def load_string(self, str):
         # protects content: "..." strings
@@ -793,8 +1070,63 @@ class Scss(object):
 
         return str
 
+    def plain_css(self, str):
+        """
+        Cheaply checks if `str` is plain CSS (no variables, mixins, nesting,
+        interpolation, function calls, arithmetic or any other Sass construct),
+        returning its rules as
+        (selectors, media, properties) or None if it isn't.
+        """
+        str = _ml_comment_re.sub('', str)
+        if _sass_code_re.search(str):
+            return None
+        # Library and user functions (and arithmetic) need to be evaluated:
+        functions = set(k.partition(':')[0] for k in fnct)
+        functions.update(k[10:].partition(':')[0] for k in self._scss_opts if k.startswith('@function '))
+        str = _colors_re.sub(lambda m: _colors.get(m.group(0), m.group(0)), str)
+        rules = []
+        selectors = media = properties = None
+        for m in _plain_css_re.finditer(str):
+            code, delim = m.group(1).strip(), m.group(2)
+            if delim == '{':
+                if selectors is not None:
+                    return None # nested block
+                elif code.startswith('@media '):
+                    if media is not None:
+                        return None
+                    media = code[7:].strip()
+                else:
+                    selectors = self.normalize_selectors(code)
+                    properties = []
+            elif code:
+                prop, colon, value = code.partition(':')
+                if selectors is None or not colon or not delim:
+                    return None # top level statement or property
+                for part in _quoted_or_url_re.split(value)[::2]:
+                    if _plain_math_re.search(part) or any(name.replace('_', '-') in functions for name in _function_call_re.findall(part)):
+                        return None
+                properties.append((prop.strip(), _spaces_re.sub(' ', value.strip())))
+            if delim == '}':
+                if selectors is not None:
+                    rules.append((selectors, media, properties))
+                    selectors = None
+                elif media is not None:
+                    media = None
+                else:
+                    return None
+            elif not delim:
+                break
+        if selectors is not None or media is not None:
+            return None
+        return rules
+
     def parse_scss_string(self, fileid, str):
-        str = self.load_string(str)
+        try:
+            str = self._loaded[str]
+        except KeyError:
+            if len(self._loaded) >= 10:
+                self._loaded.clear()
+            self._loaded[str] = str = self.load_string(str)
         rule = spawn_rule(fileid=fileid, codestr=str, context=self._scss_vars, options=self._scss_opts, file=fileid)
         self.children.append(rule)
         return str
@@ -820,7 +1152,7 @@ class Scss(object):
 
             # prepare maps:
             if _parents:
-                rule[SELECTORS] = ','.join(_selectors) + ' extends ' + '&'.join(_parents)
+                rule[SELECTORS] = ','.join(_selectors) + ' extends ' + '&'.join(sorted(_parents))
             rule[POSITION] = pos
             selectors = rule[SELECTORS]
             self.parts.setdefault(selectors, [])
@@ -948,19 +1280,30 @@ class Scss(object):
                 if param:
                     new_params.append(param)
                     if default:
-                        default = self.apply_vars(default, rule[CONTEXT], None, rule)
                         defaults[param] = default
-            context = rule[CONTEXT].copy()
-            for p in new_params:
-                context.pop(p, None)
-            mixin = [ list(new_params), defaults, self.apply_vars(c_codestr, context, None, rule) ]
+            mixin = [ list(new_params), defaults, c_codestr ]
+            # Variables are substituted when the definition is first used,
+            # keep the ones it can read (and what they map to):
+            context = rule[CONTEXT]
+            _context = {}
+            for v in set(_function_vars_re.findall(name + c_codestr)):
+                while v in context and v not in _context:
+                    _context[v] = context[v]
+                    v = context[v]
+            self._unprepared[id(mixin)] = (mixin, _context)
             if code == '@function':
+                self._functions_generation += 1
+                self._function_names.add(funct.replace('_', '-'))
                 def _call(mixin):
+                    cache = {}
                     def __call(R, *args, **kwargs):
-                        m_params = mixin[0]
+                        key = self._function_key(__call, args, kwargs)
+                        if key is not None and key in cache:
+                            ret = cache[key]
+                            return ListValue(ret) if isinstance(ret, ListValue) else ret
+                        m_params, m_defaults, m_codestr = self._prepare_mixin(mixin)
                         m_vars = rule[CONTEXT].copy()
-                        m_vars.update(mixin[1])
-                        m_codestr = mixin[2]
+                        m_vars.update(m_defaults)
                         for i, a in enumerate(args):
                             m_vars[m_params[i]] = str(a)
                         m_vars.update(kwargs)
@@ -968,10 +1311,16 @@ class Scss(object):
                         _rule = [ '', R[SELECTORS], m_codestr, set(), m_vars, _options, '', [], './', False, R[MEDIA] ]
                         self.manage_children(_rule, p_selectors, p_parents, p_children, (scope or '') + '', R[MEDIA])
                         ret = _options.pop('@return', '')
+                        if key is not None:
+                            if len(cache) >= _fnct_cache_size:
+                                cache.clear()
+                            cache[key] = ListValue(ret) if isinstance(ret, ListValue) else ret
                         return ret
                     return __call
                 _mixin = _call(mixin)
                 _mixin.mixin = mixin
+                _mixin.options = rule[OPTIONS]
+                _mixin.context = rule[CONTEXT]
                 mixin = _mixin
             # Insert as many @mixin options as the default parameters:
             while len(new_params):
@@ -982,6 +1331,149 @@ class Scss(object):
             if not new_params:
                 rule[OPTIONS][code + ' ' + funct + ':0'] = mixin
 
+    def _prepare_mixin(self, mixin):
+        """
+        Substitutes the variables of the defining context into the defaults
+        and the body of a @mixin or @function definition. This is done (only
+        once) the first time the definition is used.
+        """
+        try:
+            mixin, context = self._unprepared.pop(id(mixin))
+        except KeyError:
+            return mixin
+        params, defaults, codestr = mixin
+        for param, default in defaults.items():
+            defaults[param] = self.apply_vars(default, context, None)
+        for p in params:
+            context.pop(p, None)
+        mixin[2] = self.apply_vars(codestr, context, None)
+        return mixin
+
+    def _function_is_pure(self, fn, _seen=()):
+        """
+        Checks if the result of a user @function depends only on its arguments
+        and on the variables it reads: its body must not use directives other
+        than @return and control directives, and it can only call pure
+        library functions, plain CSS functions or other pure user functions.
+        Returns the variables read by the function (and by the functions it
+        calls) as (context, name) pairs, or None if the function is not pure.
+        """
+        generation = self._functions_generation
+        purity = getattr(fn, 'purity', None)
+        if purity is not None and purity[0] == generation:
+            return purity[1]
+        params, defaults, codestr = self._prepare_mixin(fn.mixin)
+        reads = None
+        if not _function_impure_re.search(codestr):
+            reads = [ (fn.context, v) for v in sorted(set(_function_vars_re.findall(codestr)) - set(params)) ]
+            deps = []
+            for name in set(_function_call_re.findall(codestr)):
+                if not self._pure_calls(name, fn.options, reads, deps, _seen + (fn,)):
+                    reads = None
+                    break
+            else:
+                reads = tuple(reads)
+        if not _seen:
+            fn.purity = (generation, reads)
+        return reads
+
+    def _pure_calls(self, name, options, reads, deps, _seen=()):
+        """
+        Checks if calling the function `name` (as seen from `options`) is
+        pure, collecting the variables it reads in `reads` and the user
+        functions it resolves to in `deps`.
+        """
+        if not _pure_fnct(name):
+            return False
+        prefix = '@function ' + name.replace('_', '-') + ':'
+        for k, f in options.items():
+            if k.startswith(prefix):
+                deps.append((k, f))
+                if f not in _seen:
+                    _reads = self._function_is_pure(f, _seen)
+                    if _reads is None:
+                        return False
+                    reads.extend(_reads)
+        return True
+
+    def _function_key(self, fn, args, kwargs):
+        """
+        Returns the key used to memoize a call to a user @function, or None
+        if the call can't be memoized.
+        """
+        reads = self._function_is_pure(fn)
+        if reads is None:
+            return None
+        args = tuple(str(a) for a in args)
+        if any('$' in a for a in args):
+            return None
+        values = tuple(ctx.get(v) for ctx, v in reads)
+        if any(isinstance(v, basestring) and '$' in v for v in values):
+            return None
+        try:
+            return (
+                self._functions_generation,
+                args,
+                tuple(sorted((k, _value_key(v)) for k, v in kwargs.items())),
+                tuple(_value_key(v) for v in values),
+            )
+        except TypeError:
+            return None
+
+    def _mixin_deps(self, mixin, options, reads, deps, _seen=()):
+        """
+        Checks if the expansion of a @mixin depends only on its arguments, on
+        the variables it reads and on the definitions it uses: its body can
+        only use control directives, @extend and @include of other such
+        mixins, and call pure functions (see `_function_is_pure()`). Collects
+        the variables read in `reads` (a context of None stands for the
+        including rule's context) and the definitions used in `deps`.
+        """
+        params, defaults, codestr = self._prepare_mixin(mixin)
+        if _mixin_impure_re.search(codestr):
+            return False
+        reads.extend((None, v) for v in set(_function_vars_re.findall(codestr)) if v not in params)
+        for name in set(_function_call_re.findall(codestr)):
+            if not self._pure_calls(name, options, reads, deps):
+                return False
+        _seen += (mixin,)
+        for name in set(_mixin_include_re.findall(codestr)):
+            prefix = '@mixin ' + name + ':'
+            for k, m in options.items():
+                if k.startswith(prefix):
+                    deps.append((k, m))
+                    if not any(m is s for s in _seen) and not self._mixin_deps(m, options, reads, deps, _seen):
+                        return False
+        return True
+
+    def _include_key(self, mixin, rule, scope, m_vars):
+        """
+        Returns the key used to cache the expansion of a @mixin, or None if
+        the expansion can't be cached.
+        """
+        reads = []
+        deps = [ (None, mixin) ]
+        if not self._mixin_deps(mixin, rule[OPTIONS], reads, deps):
+            return None
+        context = rule[CONTEXT]
+        values = {}
+        for ctx, v in reads:
+            if ctx is None:
+                values[None, v] = m_vars[v] if v in m_vars else context.get(v)
+            else:
+                values[id(ctx), v] = ctx.get(v)
+        if any(isinstance(v, basestring) and '$' in v for v in values.values() + m_vars.values()):
+            return None
+        try:
+            return (
+                scope,
+                tuple(sorted((k, _value_key(v)) for k, v in m_vars.items())),
+                tuple(sorted((k, _value_key(v)) for k, v in values.items())),
+                tuple(sorted(set((k, id(d)) for k, d in deps))),
+            ), deps
+        except TypeError:
+            return None
+
     @print_timing(10)
     def _do_include(self, rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr, code, name):
         """
@@ -1006,9 +1498,8 @@ class Scss(object):
                 new_params[varname] = param
         mixin = rule[OPTIONS].get('@mixin ' + funct + ':' + str(num_args))
         if mixin:
-            m_params = mixin[0]
-            m_vars = mixin[1].copy()
-            m_codestr = mixin[2]
+            m_params, m_defaults, m_codestr = self._prepare_mixin(mixin)
+            m_vars = m_defaults.copy()
             for varname, value in new_params.items():
                 try:
                     m_param = m_params[varname]
@@ -1021,11 +1512,34 @@ class Scss(object):
                     if isinstance(m_vars[p], basestring):
                         value = self.calculate(m_vars[p], m_vars, rule[OPTIONS], rule)
                         m_vars[p] = value
+            # Expansions which only add properties and extends are cached
+            # (and replayed) as long as they don't depend on anything else:
+            key = self._include_key(mixin, rule, scope, m_vars)
+            if key is not None:
+                key, deps = key
+                cached = self._includes.get(key)
+                if cached is not None:
+                    rule[PROPERTIES].extend(cached[0])
+                    p_parents.update(cached[1])
+                    return
             _rule = list(rule)
             _rule[CODESTR] = m_codestr
             _rule[CONTEXT] = rule[CONTEXT].copy()
             _rule[CONTEXT].update(m_vars)
-            self.manage_children(_rule, p_selectors, p_parents, p_children, scope, media)
+            if key is None:
+                self.manage_children(_rule, p_selectors, p_parents, p_children, scope, media)
+            else:
+                pos = len(rule[PROPERTIES])
+                _parents = set()
+                _children = deque()
+                self.manage_children(_rule, p_selectors, _parents, _children, scope, media)
+                p_parents.update(_parents)
+                if _children:
+                    p_children.extendleft(reversed(_children))
+                else:
+                    if len(self._includes) >= _fnct_cache_size:
+                        self._includes.clear()
+                    self._includes[key] = (rule[PROPERTIES][pos:], _parents, deps)
         else:
             log.error("Required mixin not found: %s:%d", funct, num_args)
 
@@ -1041,6 +1555,16 @@ class Scss(object):
             for name in names:
                 name = dequote(name.strip())
                 if '@import ' + name not in rule[OPTIONS]: # If already imported in this scope, skip...
+                    import_once = rule[OPTIONS].get('import_once')
+                    if import_once:
+                        key = (name, os.path.dirname(rule[PATH]))
+                        if key in self._imports:
+                            # Already imported elsewhere, just bring in its definitions:
+                            options, context = self._imports[key]
+                            rule[OPTIONS].update(options)
+                            rule[CONTEXT].update(context)
+                            continue
+                    i_rules = None
                     try:
                         raise KeyError
                         i_codestr = self._scss_files[name]
@@ -1071,13 +1595,30 @@ class Scss(object):
                                 break
                         if i_codestr is None:
                             i_codestr = self._do_magic_import(rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr, code, name)
+                        elif scope is None:
+                            i_rules = self.plain_css(i_codestr)
                         i_codestr = self._scss_files[name] = i_codestr and self.load_string(i_codestr)
                     if i_codestr is None:
                         log.warn("File to import not found or unreadable: '%s'\nLoad paths:\n\t%s", filename, "\n\t".join(load_paths))
                     else:
                         _rule = spawn_rule(rule, codestr=i_codestr, path=full_filename, file=name)
-                        self.manage_children(_rule, p_selectors, p_parents, p_children, scope, media)
+                        if import_once:
+                            options, context = rule[OPTIONS].copy(), rule[CONTEXT].copy()
+                        if i_rules is not None:
+                            # Plain CSS doesn't need to be evaluated, just nested:
+                            for selectors, _media, properties in i_rules:
+                                better_selectors = ','.join(sorted(set((p_selector + ' ' + c_selector) if p_selector else c_selector for c_selector in selectors.split(',') for p_selector in p_selectors)))
+                                _rule = spawn_rule(fileid=rule[FILEID], codestr='', context=rule[CONTEXT], options=rule[OPTIONS], selectors=better_selectors, properties=list(properties), path=full_filename, file=name, media=(media or []) + [ _media ] if _media else media)
+                                p_children.appendleft(_rule)
+                        else:
+                            self.manage_children(_rule, p_selectors, p_parents, p_children, scope, media)
                         rule[OPTIONS]['@import ' + name] = True
+                        if import_once:
+                            # Keep the definitions the file made (or changed):
+                            self._imports[key] = (
+                                dict((k, v) for k, v in rule[OPTIONS].items() if options.get(k, self) is not v),
+                                dict((k, v) for k, v in rule[CONTEXT].items() if context.get(k, self) is not v),
+                            )
         else:
             rule[PROPERTIES].append((c_property, None))
 
@@ -1239,6 +1780,33 @@ class Scss(object):
         _rule[PROPERTIES] = rule[CONTEXT]
         self.manage_children(_rule, p_selectors, p_parents, p_children, scope, media)
 
+    def _lazy_calculate(self, _base_str, rule):
+        """
+        Returns the value of the expression `_base_str` as a Thunk evaluated
+        on first use, or evaluates it right away if its value could change
+        before then (i.e. if it calls impure or user defined functions).
+        """
+        context, options = rule[CONTEXT], rule[OPTIONS]
+        if options is not None and '!default' not in _base_str:
+            deps = []
+            for name in set(_function_call_re.findall(_base_str)):
+                if not self._pure_calls(name, options, [], deps) or deps:
+                    break
+            else:
+                # Snapshot the variables read by the expression:
+                _context = {}
+                for v in set(_function_vars_re.findall(_base_str)):
+                    if v in context:
+                        _v = context[v]
+                        if isinstance(_v, basestring) and '$' in _v:
+                            break
+                        _context[v] = _v
+                else:
+                    _rule = list(rule)
+                    _rule[CONTEXT] = _context
+                    return Thunk(self.calculate, _base_str, _rule)
+        return self.calculate(_base_str, context, options, rule)
+
     @print_timing(10)
     def _get_properties(self, rule, p_selectors, p_parents, p_children, scope, media, c_property, c_codestr):
         """
@@ -1251,10 +1819,18 @@ class Scss(object):
             is_var = False
         prop = prop.strip()
         if prop:
+            _prop = (scope or '') + prop
             if value:
                 value = value.strip()
-                value = self.calculate(value, rule[CONTEXT], rule[OPTIONS], rule)
-            _prop = (scope or '') + prop
+                if is_var or prop.startswith('$'):
+                    if value.endswith('!default'):
+                        if _prop in rule[CONTEXT]:
+                            # The variable is already set, don't bother evaluating the default:
+                            return
+                        value = value[:-8].rstrip()
+                    value = self._lazy_calculate(value, rule)
+                else:
+                    value = self.calculate(value, rule[CONTEXT], rule[OPTIONS], rule)
             if is_var or prop.startswith('$') and value is not None:
                 if isinstance(value, basestring):
                     if '!default' in value:
@@ -1264,12 +1840,12 @@ class Scss(object):
                             value = value.replace('!default', '').replace('  ', ' ').strip()
                 elif isinstance(value, ListValue):
                     value = ListValue(value)
-                    for k, v in value.value.items():
+                    for i, v in enumerate(value.value):
                         if v == '!default':
                             if _prop in rule[CONTEXT]:
                                 value = None
                             else:
-                                del value.value[k]
+                                del value.value[i]
                                 value = value.first() if len(value) == 1 else value
                             break
                 if value is not None:
@@ -1287,6 +1863,10 @@ class Scss(object):
             rule[CODESTR] = c_codestr
             self.manage_children(rule, p_selectors, p_parents, p_children, scope, media)
         else:
+            if self._variables_only:
+                # Nested rules work on copies of the context:
+                return
+
             c_property = self.apply_vars(c_property, rule[CONTEXT], rule[OPTIONS], rule, True)
 
             c_selectors = self.normalize_selectors(c_property)
@@ -1364,7 +1944,14 @@ class Scss(object):
                 parent_found.extend(p_rules)
 
             if new_selectors:
+                # Don't let chains of @extend blow the selectors up:
+                new_selectors.difference_update(_p_selectors)
+                room = _extended_selectors_size - len(_p_selectors)
+                if len(new_selectors) > room:
+                    log.warn("Too many selectors extending %s, only %d kept", parent, _extended_selectors_size)
+                    new_selectors = sorted(new_selectors)[:max(room, 0)]
                 new_selectors = self.normalize_selectors(p_selectors, new_selectors)
+                self._extended.add(new_selectors.partition(' extends ')[0])
                 # rename node:
                 if new_selectors != p_selectors:
                     del self.parts[p_selectors]
@@ -1439,6 +2026,19 @@ class Scss(object):
                             _new_options.update(rule[OPTIONS])
                             rule[OPTIONS] = _new_options
 
+        # Once all the extends are done, drop the redundant selectors they
+        # left behind (this can't be done while linking, as other extends
+        # might still be looking for them). Only the selectors extends added
+        # to are pruned, hand written ones are left as they are:
+        pruned = {}
+        for rules in self.parts.values():
+            for rule in rules:
+                selectors = rule[SELECTORS]
+                if selectors.partition(' extends ')[0] in self._extended:
+                    if selectors not in pruned:
+                        pruned[selectors] = self.prune_selectors(selectors)
+                    rule[SELECTORS] = pruned[selectors]
+
     @print_timing(3)
     def manage_order(self):
         # order rules according with their dependencies
@@ -1468,7 +2068,7 @@ class Scss(object):
                         self.css_files.append(fileid)
 
     @print_timing(3)
-    def create_css(self, fileid=None):
+    def create_css(self, fileid=None, compress=None, verbosity=None):
         """
         Generate the final CSS string
         """
@@ -1477,16 +2077,191 @@ class Scss(object):
         else:
             rules = self.rules
 
-        compress = self._scss_opts.get('compress', 1)
+        if self._used is not None:
+            rules = self.prune_unused_rules(rules)
+
+        if compress is None:
+            compress = self._scss_opts.get('compress', 1)
         if compress:
             sc, sp, tb, nl = False, '', '', ''
+            if self._scss_opts.get('compress_rules', 0):
+                rules = self.minify_rules(rules)
         else:
             sc, sp, tb, nl = True, ' ', '  ', '\n'
 
+        group_media = self._scss_opts.get('group_media', 0)
+        if group_media:
+            rules = self.group_media_rules(rules)
+
         scope = set()
-        return self._create_css(rules, scope, sc, sp, tb, nl)
+        return self._create_css(rules, scope, sc, sp, tb, nl, verbosity, group_media)
+
+    def use_corpus(self, paths=(), inventory=(), safelist=()):
+        """
+        Makes the generated CSS leave out the rules that can't match anything
+        in the given HTML or template files. The `inventory` adds names to
+        the ones found in the files (as in `.class`, `#id` or `tag`) and the
+        `safelist` has the names (or glob patterns, as in `.js-*`) to keep
+        even if they're not found (i.e. classes set from javascript). Calling
+        it without arguments stops the pruning.
+        """
+        if not paths and not inventory and not safelist:
+            self._used = None
+            return
+        used = set(inventory)
+        patterns = []
+        for path in paths:
+            try:
+                html = open(path, 'rt').read()
+            except IOError:
+                log.warn("File to scan for used selectors not found: %s", path)
+                continue
+            used.update(tag.lower() for tag in _html_tag_re.findall(html))
+            for m in _html_attr_re.finditer(html):
+                prefix = '.' if m.group(1).lower() == 'class' else '#'
+                value = m.group(2) or m.group(3) or m.group(4) or ''
+                # Template statements ({% if %}...) separate names, but
+                # template variables could output anything so names touching
+                # one are kept as patterns (i.e. btn-{{ kind }} as .btn-*):
+                value = _html_template_re.sub(lambda m: '*' if m.group(0)[1] == '{' else ' ', value)
+                for name in value.split():
+                    if '*' not in name:
+                        used.add(prefix + name)
+                    elif prefix + name not in patterns:
+                        patterns.append(prefix + name)
+        self._used = (used, tuple(safelist) + tuple(patterns))
+
+    def prune_unused_rules(self, rules):
+        """
+        Returns the rules with the selectors that can't match anything in the
+        corpus (see use_corpus()) removed, dropping the rules left without
+        selectors. Pseudo-classes, attributes and at-rules are always kept.
+        """
+        used, safelist = self._used
+        check_tags = any(name[0] not in '.#' for name in used)
+        # Elements browsers add by themselves even if the HTML doesn't have them:
+        found = dict.fromkeys(('*', 'html', 'head', 'body', 'tbody'), True)
 
-    def _create_css(self, rules, scope=None, sc=True, sp=' ', tb='  ', nl='\n'):
+        def _found(name):
+            try:
+                return found[name]
+            except KeyError:
+                found[name] = ret = name in used or any(fnmatch.fnmatchcase(name, p) for p in safelist)
+                return ret
+
+        def _matches(selector):
+            parsed = _parse_selector(selector)
+            if parsed is None:
+                return True # don't know, better keep it
+            for combinator, (element, others, pseudos) in parsed[1]:
+                if check_tags and element is not None and not _found(element):
+                    return False
+                for simple in others:
+                    if simple[0] in '.#' and not _found(simple):
+                        return False
+            return True
+
+        pruned = {}
+        _rules = []
+        for rule in rules:
+            selectors = rule[SELECTORS]
+            if selectors and not selectors.startswith('@'):
+                if selectors not in pruned:
+                    pruned[selectors] = ','.join(s for s in selectors.split(',') if _matches(s))
+                if not pruned[selectors]:
+                    continue
+                if pruned[selectors] != selectors:
+                    rule = spawn_rule(rule, selectors=pruned[selectors])
+            _rules.append(rule)
+        return _rules
+
+    def group_media_rules(self, rules):
+        """
+        Returns the rules reordered so the ones with the same media queries
+        come together. A rule is only moved up to an earlier one with the same
+        media when no rule in between sets any of its properties (or their
+        shorthands or longhands).
+        """
+        blocks = []
+        last = {} # the last block setting each family of properties
+        found = {}
+        for rule in rules:
+            props = set(_property_family(prop) for prop, value in rule[PROPERTIES])
+            media = rule[MEDIA] and _media_key(rule[MEDIA])
+            i = found.get(media) if media else None
+            if i is not None and max(last.get(prop, -1) for prop in props) <= i:
+                blocks[i].append(rule)
+            else:
+                i = len(blocks)
+                if media:
+                    found[media] = i
+                blocks.append([ rule ])
+            for prop in props:
+                last[prop] = i
+        return [ rule for block in blocks for rule in block ]
+
+    def minify_rules(self, rules):
+        """
+        Returns a smaller list of rules for the same CSS: rules with the same
+        selectors or the same properties are merged (as long as that doesn't
+        change the cascade), overridden properties are removed and numbers
+        are shortened. The original rules are left untouched.
+        """
+        def _merge(rules, key, merge):
+            result = []
+            last = {} # the last index declaring each family of properties
+            found = {}
+            for rule in rules:
+                props = set(_property_family(prop) for prop, value in rule[PROPERTIES])
+                _key = key(rule)
+                i = found.get(_key)
+                # Merging moves the properties up to the earlier rule, so no rule
+                # in between can be setting any of their families:
+                if i is not None and max(last.get(prop, -1) for prop in props) <= i:
+                    result[i] = rule = merge(result[i], rule)
+                else:
+                    i = found[_key] = len(result)
+                    result.append(rule)
+                for prop in props:
+                    last[prop] = i
+            return result
+
+        # Merge rules with the same selectors (but not at-rules, two
+        # @font-face are two different fonts):
+        rules = _merge(rules,
+            lambda rule: (rule[SELECTORS], tuple(rule[MEDIA] or ())) if not rule[SELECTORS].startswith('@') else id(rule),
+            lambda first, second: spawn_rule(first, properties=first[PROPERTIES] + second[PROPERTIES]))
+
+        # Remove overridden properties:
+        _rules = []
+        for rule in rules:
+            # The last important value wins, or else the last value (at-rules
+            # keep them all, i.e. every src of a @font-face):
+            at_rule = rule[SELECTORS].startswith('@')
+            winners = {}
+            for i, (prop, value) in enumerate(rule[PROPERTIES]):
+                if value is not None and (at_rule or prop not in winners or '!important' in value or '!important' not in rule[PROPERTIES][winners[prop]][1]):
+                    winners[prop] = i
+            properties = []
+            for i, (prop, value) in enumerate(rule[PROPERTIES]):
+                if value is not None:
+                    # ...but vendor specific fallbacks are kept:
+                    if not at_rule and winners[prop] != i and not (i < winners[prop] and _vendor_value_re.search(value)):
+                        continue
+                    parts = _quoted_or_url_re.split(value)
+                    parts[::2] = [ _zero_re.sub('.', p) for p in parts[::2] ]
+                    value = ''.join(parts)
+                properties.append((prop, value))
+            _rules.append(spawn_rule(rule, properties=properties))
+
+        # Merge selectors with the same properties (but not at-rules or vendor
+        # specific pseudo selectors, browsers drop the whole rule if they don't
+        # know one of its selectors):
+        return _merge(_rules,
+            lambda rule: (tuple(rule[PROPERTIES]), tuple(rule[MEDIA] or ())) if not rule[SELECTORS].startswith('@') and not _vendor_pseudo_re.search(rule[SELECTORS]) else id(rule),
+            lambda first, second: spawn_rule(first, selectors=','.join(sorted(set(first[SELECTORS].split(',') + second[SELECTORS].split(','))))))
+
+    def _create_css(self, rules, scope=None, sc=True, sp=' ', tb='  ', nl='\n', verbosity=None, group_media=False):
         scope = set() if scope is None else scope
 
         open_selectors = False
@@ -1506,7 +2281,7 @@ class Scss(object):
                 selectors = rule[SELECTORS]
                 media = rule[MEDIA]
                 _tb = tb if old_media else ''
-                if old_media != media or media is not None:
+                if old_media != media or media is not None and not group_media:
                     if open_selectors:
                         if not sc:
                             if result[-1] == ';':
@@ -1520,7 +2295,7 @@ class Scss(object):
                         result += '}' + nl
                         open_media = False
                     if media:
-                        result += '@media ' + (' and ').join(set(media)) + sp + '{' + nl
+                        result += '@media ' + ' and '.join(_media_key(media)) + sp + '{' + nl
                         open_media = True
                     old_media = media
                     old_selectors = None # force entrance to add a new selector
@@ -1541,12 +2316,12 @@ class Scss(object):
                     scope = set()
                 if selectors:
                     _tb += tb
-                if rule[OPTIONS].get('verbosity', 0) > 1:
+                if (rule[OPTIONS].get('verbosity', 0) if verbosity is None else verbosity) > 1:
                     result += _tb + '/* file: ' + rule[FILEID] + ' */' + nl
                     if rule[CONTEXT]:
                         result += _tb + '/* vars:' + nl
-                        for k, v in rule[CONTEXT].items():
-                            result += _tb + _tb + k + ' = ' + v + ';' + nl
+                        for k, v in sorted(rule[CONTEXT].items()):
+                            result += _tb + _tb + k + ' = ' + to_str(v) + ';' + nl
                         result += _tb + '*/' + nl
                 result += self._print_properties(rule[PROPERTIES], scope, [old_property], sc, sp, _tb, nl, wrap)
 
@@ -1603,16 +2378,52 @@ class Scss(object):
                     self._replaces[_base_str] = better_expr_str
                     return better_expr_str
 
+            key = None
+            if '$' in _base_str:
+                # Expressions reading the same values have the same value:
+                key = self._calculation_key(_base_str, context, rule)
+                if key is not None and key in self._calculations:
+                    better_expr_str = self._calculations[key]
+                    return ListValue(better_expr_str) if isinstance(better_expr_str, ListValue) else better_expr_str
+
             better_expr_str = self.do_glob_math(better_expr_str, context, options, rule)
 
             better_expr_str = eval_expr(better_expr_str, rule, True)
             if better_expr_str is None:
                 better_expr_str = self.apply_vars(_base_str, context, options, rule)
 
-            if '$' not in _base_str:
+            if key is not None:
+                if len(self._calculations) >= _calculations_size:
+                    self._calculations.clear()
+                self._calculations[key] = ListValue(better_expr_str) if isinstance(better_expr_str, ListValue) else better_expr_str
+            elif '$' not in _base_str:
                 self._replaces[_base_str] = better_expr_str
         return better_expr_str
 
+    def _calculation_key(self, _base_str, context, rule):
+        """
+        Returns the key used to memoize the value of an expression which reads
+        variables (its text and the values it reads), or None if its value
+        could depend on something else.
+        """
+        if rule is None or context is not rule[CONTEXT]:
+            return None
+        for name in _function_call_re.findall(_base_str):
+            if name.replace('_', '-') in self._function_names or not _pure_fnct(name):
+                return None
+        values = []
+        for v in sorted(set(_function_vars_re.findall(_base_str))):
+            value = context.get(v)
+            if isinstance(value, Thunk):
+                value = value.value
+            if isinstance(value, basestring) and '$' in value:
+                return None
+            try:
+                values.append((v, _value_key(value)))
+            except TypeError:
+                return None
+        return _base_str, tuple(values)
+
     def _calculate_expr(self, context, options, rule, _dequote):
         def __calculate_expr(result):
             _group0 = result.group(1)
@@ -1647,8 +2458,10 @@ class Scss(object):
         return cont
 
     @print_timing(3)
-    def post_process(self, cont):
-        compress = self._scss_opts.get('compress', 1) and 'compress_' or ''
+    def post_process(self, cont, compress=None):
+        if compress is None:
+            compress = self._scss_opts.get('compress', 1)
+        compress = compress and 'compress_' or ''
         # short colors:
         if self._scss_opts.get(compress+'short_colors', 1):
             cont = _short_color_re.sub(r'#\1\2\3', cont)
@@ -1674,7 +2487,7 @@ try:
 except:
     import StringIO
 try:
-    from PIL import Image, ImageDraw
+    from PIL import Image, ImageChops, ImageDraw
 except ImportError:
     Image = None
 
@@ -1719,9 +2532,19 @@ def unescape(str):
 ################################################################################
 # Sass/Compass Library Functions:
 
+def pure(fn):
+    """
+    Decorator for library functions whose result depends only on their
+    arguments, so `call()` can memoize them (see `_call_pure()`).
+    """
+    fn.pure = True
+    return fn
+
+@pure
 def _rgb(r, g, b, type='rgb'):
     return _rgba(r, g, b, 1.0, type)
 
+@pure
 def _rgba(r, g, b, a, type='rgba'):
     c = NumberValue(r), NumberValue(g), NumberValue(b), NumberValue(a)
 
@@ -1743,25 +2566,32 @@ def _color_type(color, a, type):
     col += [ type ]
     return ColorValue(col)
 
+@pure
 def _rgb2(color):
     return _color_type(color, 1.0, 'rgb')
 
+@pure
 def _rgba2(color, a=None):
     return _color_type(color, a, 'rgba')
 
+@pure
 def _hsl2(color):
     return _color_type(color, 1.0, 'hsl')
 
+@pure
 def _hsla2(color, a=None):
     return _color_type(color, a, 'hsla')
 
+@pure
 def _ie_hex_str(color):
     c = ColorValue(color).value
     return StringValue('#%02X%02X%02X%02X' % (round(c[3]*255), round(c[0]), round(c[1]), round(c[2])))
 
+@pure
 def _hsl(h, s, l, type='hsl'):
     return _hsla(h, s, l, 1.0, type)
 
+@pure
 def _hsla(h, s, l, a, type='hsla'):
     c = NumberValue(h), NumberValue(s), NumberValue(l), NumberValue(a)
     col = [ c[0] if (c[0].unit == '%' and c[0].value > 0 and c[0].value <= 1) else (c[0].value % 360.0) / 360.0 ]
@@ -1791,12 +2621,13 @@ def __rgba_op(op, color, r, g, b, a):
     # Validations:
     r = 255.0, 255.0, 255.0, 1.0
     c = [ 0.0 if c[i] < 0 else r[i] if c[i] > r[i] else c[i] for i in range(4) ]
-    color.value = tuple(c)
-    return color
+    return color.replace(tuple(c))
 
+@pure
 def _opacify(color, amount):
     return __rgba_op(operator.__add__, color, 0, 0, 0, amount)
 
+@pure
 def _transparentize(color, amount):
     return __rgba_op(operator.__sub__, color, 0, 0, 0, amount)
 
@@ -1822,30 +2653,37 @@ def __hsl_op(op, color, h, s, l):
     c = [ 0.0 if c[i] < 0 else r[i] if c[i] > r[i] else c[i] for i in range(3) ]
     # Convert back to RGB:
     c = colorsys.hls_to_rgb(c[0] / 360.0, 0.999999 if c[2] == 1 else c[2], 0.999999 if c[1] == 1 else c[1])
-    color.value = (c[0] * 255.0, c[1] * 255.0, c[2] * 255.0, color.value[3])
-    return color
+    return color.replace((c[0] * 255.0, c[1] * 255.0, c[2] * 255.0, color.value[3]))
 
+@pure
 def _lighten(color, amount):
     return __hsl_op(operator.__add__, color, 0, 0, amount)
 
+@pure
 def _darken(color, amount):
     return __hsl_op(operator.__sub__, color, 0, 0, amount)
 
+@pure
 def _saturate(color, amount):
     return __hsl_op(operator.__add__, color, 0, amount, 0)
 
+@pure
 def _desaturate(color, amount):
     return __hsl_op(operator.__sub__, color, 0, amount, 0)
 
+@pure
 def _grayscale(color):
     return __hsl_op(operator.__sub__, color, 0, 100.0, 0)
 
+@pure
 def _adjust_hue(color, degrees):
     return __hsl_op(operator.__add__, color, degrees, 0, 0)
 
+@pure
 def _complement(color):
     return __hsl_op(operator.__add__, color, 180.0, 0, 0)
 
+@pure
 def _invert(color):
     """
     Returns the inverse (negative) of a color.
@@ -1853,20 +2691,21 @@ def _invert(color):
     """
     col = ColorValue(color)
     c = col.value
-    c[0] = 255.0 - c[0]
-    c[1] = 255.0 - c[1]
-    c[2] = 255.0 - c[2]
-    return col
+    return col.replace((255.0 - c[0], 255.0 - c[1], 255.0 - c[2], c[3]))
 
+@pure
 def _adjust_lightness(color, amount):
     return __hsl_op(operator.__add__, color, 0, 0, amount)
 
+@pure
 def _adjust_saturation(color, amount):
     return __hsl_op(operator.__add__, color, 0, amount, 0)
 
+@pure
 def _scale_lightness(color, amount):
     return __hsl_op(operator.__mul__, color, 0, 0, amount)
 
+@pure
 def _scale_saturation(color, amount):
     return __hsl_op(operator.__mul__, color, 0, amount, 0)
 
@@ -1877,15 +2716,19 @@ def _asc_color(op, color, saturation=None, lightness=None, red=None, green=None,
         color = __rgba_op(op, color, red, green, blue, alpha)
     return color
 
+@pure
 def _adjust_color(color, saturation=None, lightness=None, red=None, green=None, blue=None, alpha=None):
     return _asc_color(operator.__add__, color, saturation, lightness, red, green, blue, alpha)
 
+@pure
 def _scale_color(color, saturation=None, lightness=None, red=None, green=None, blue=None, alpha=None):
     return _asc_color(operator.__mul__, color, saturation, lightness, red, green, blue, alpha)
 
+@pure
 def _change_color(color, saturation=None, lightness=None, red=None, green=None, blue=None, alpha=None):
     return _asc_color(None, color, saturation, lightness, red, green, blue, alpha)
 
+@pure
 def _mix(color1, color2, weight=None):
     """
     Mixes together two colors. Specifically, takes the average of each of the
@@ -1948,41 +2791,40 @@ def _mix(color1, color2, weight=None):
     r = [ w2, w2, w2, 1 - p ]
 
     color = ColorValue(None).merge(c1).merge(c2)
-    color.value = [ c1[i] * q[i] + c2[i] * r[i] for i in range(4) ]
-
-    return color
+    return color.replace(tuple( c1[i] * q[i] + c2[i] * r[i] for i in range(4) ))
 
+@pure
 def _red(color):
     c = ColorValue(color).value
     return NumberValue(c[0])
+@pure
 def _green(color):
     c = ColorValue(color).value
     return NumberValue(c[1])
+@pure
 def _blue(color):
     c = ColorValue(color).value
     return NumberValue(c[2])
+@pure
 def _alpha(color):
     c = ColorValue(color).value
     return NumberValue(c[3])
 
+@pure
 def _hue(color):
     c = ColorValue(color).value
     h, l, s = colorsys.rgb_to_hls(c[0] / 255.0, c[1] / 255.0, c[2] / 255.0)
-    ret = NumberValue(h * 360.0)
-    ret.units = { 'deg': _units_weights.get('deg', 1), '_': 'deg' }
-    return ret
+    return NumberValue(h * 360.0, 'deg')
+@pure
 def _saturation(color):
     c = ColorValue(color).value
     h, l, s = colorsys.rgb_to_hls(c[0] / 255.0, c[1] / 255.0, c[2] / 255.0)
-    ret = NumberValue(s)
-    ret.units = { '%': _units_weights.get('%', 1), '_': '%' }
-    return ret
+    return NumberValue(s, '%')
+@pure
 def _lightness(color):
     c = ColorValue(color).value
     h, l, s = colorsys.rgb_to_hls(c[0] / 255.0, c[1] / 255.0, c[2] / 255.0)
-    ret = NumberValue(l)
-    ret.units = { '%': _units_weights.get('%', 1), '_': '%' }
-    return ret
+    return NumberValue(l, '%')
 
 def __color_stops(percentages, *args):
     if len(args) == 1:
@@ -2057,6 +2899,7 @@ def __color_stops(percentages, *args):
         stops = [ s * max_stops for s in stops ]
     return zip(stops, colors)
 
+@pure
 def _grad_color_stops(*args):
     color_stops = __color_stops(True, *args)
     ret = ', '.join([ 'color-stop(%s, %s)' % (to_str(s), c) for s, c in color_stops ])
@@ -2074,20 +2917,24 @@ def __grad_position(index, default, radial, color_stops):
         stops = NumberValue(default)
     return stops
 
+@pure
 def _grad_end_position(*color_stops):
     color_stops = __color_stops(False, *color_stops)
     return NumberValue(__grad_end_position(False, color_stops))
 
+@pure
 def _color_stops(*args):
     color_stops = __color_stops(False, *args)
     ret = ', '.join([ '%s %s' % (c, to_str(s)) for s, c in color_stops ])
     return StringValue(ret)
 
+@pure
 def _color_stops_in_percentages(*args):
     color_stops = __color_stops(True, *args)
     ret = ', '.join([ '%s %s' % (c, to_str(s)) for s, c in color_stops ])
     return StringValue(ret)
 
+@pure
 def _radial_gradient(*args):
     color_stops = args
     position_and_angle = None
@@ -2108,7 +2955,7 @@ def _radial_gradient(*args):
     ]
     args.extend('%s %s' % (c, to_str(s)) for s, c in color_stops)
     to__s = 'radial-gradient(' + ', '.join(to_str(a) for a in args or [] if a is not None) + ')'
-    ret = StringValue(to__s)
+    ret = PrefixedStringValue(to__s)
 
     def to__moz():
         return StringValue('-moz-' + to__s)
@@ -2142,6 +2989,7 @@ def _radial_gradient(*args):
 
     return ret
 
+@pure
 def _linear_gradient(*args):
     color_stops = args
     position_and_angle = None
@@ -2155,7 +3003,7 @@ def _linear_gradient(*args):
     ]
     args.extend('%s %s' % (c, to_str(s)) for s, c in color_stops)
     to__s = 'linear-gradient(' + ', '.join(to_str(a) for a in args or [] if a is not None) + ')'
-    ret = StringValue(to__s)
+    ret = PrefixedStringValue(to__s)
 
     def to__moz():
         return StringValue('-moz-' + to__s)
@@ -2194,6 +3042,7 @@ def _linear_gradient(*args):
 
     return ret
 
+@pure
 def _radial_svg_gradient(*args):
     color_stops = args
     center = None
@@ -2210,6 +3059,7 @@ def _radial_svg_gradient(*args):
     inline = 'url("%s")' % escape(url)
     return StringValue(inline)
 
+@pure
 def _linear_svg_gradient(*args):
     color_stops = args
     start = None
@@ -2261,6 +3111,129 @@ def __radial_svg(color_stops, cx, cy, r):
 # Compass like functionality for sprites and images:
 sprite_maps = {}
 sprite_images = {}
+
+_sprite_pool = None
+_sprite_builds = {}
+
+def _get_sprite_pool():
+    global _sprite_pool
+    if _sprite_pool is None:
+        import atexit
+        import multiprocessing
+        _sprite_pool = multiprocessing.Pool(SPRITE_PROCESSES)
+        atexit.register(close_sprite_pool)
+    return _sprite_pool
+
+def close_sprite_pool():
+    """
+    Waits for the sprite images being built and stops the sprite processes
+    (a new pool is started if more sprite maps are built later on).
+    """
+    global _sprite_pool
+    if _sprite_pool is not None:
+        wait_sprites()
+        _sprite_pool.close()
+        _sprite_pool.join()
+        _sprite_pool = None
+
+def _build_sprite(asset_path, size, pastes, src_color, dst_color, cache):
+    """
+    Creates and saves the image of a sprite map, and then its cache, pasting
+    the (file, storage, box) source images one at a time (see
+    `_sprite_map()`). Runs in the sprite processes when there are any.
+    """
+    new_image = Image.new(
+        mode = 'RGBA',
+        size = size,
+        color = (0, 0, 0, 0)
+    )
+    for file, storage, box in pastes:
+        fp = storage.open(file) if storage is not None else open(file, 'rb')
+        try:
+            new_image.paste(Image.open(fp), box)
+        finally:
+            fp.close()
+
+    if dst_color:
+        new_image = _recolor(new_image, src_color, dst_color)
+
+    try:
+        new_image.save(asset_path)
+    except IOError:
+        log.exception("Error while saving image")
+    pickle.dump(cache, open(asset_path + '.cache', 'w'))
+
+def wait_sprites():
+    """
+    Waits for the sprite images being built in the background to be saved.
+    """
+    while _sprite_builds:
+        asset_path, (result, cache) = _sprite_builds.popitem()
+        try:
+            result.get()
+        except Exception:
+            log.exception("Error while building sprite map: %s", asset_path)
+
+def _recolor(image, src_color, dst_color):
+    """
+    Returns the RGBA image with the pixels of the `src_color` (an RGB tuple)
+    changed to the `dst_color`, keeping their alpha. Works on whole bands
+    through lookup tables instead of going pixel by pixel.
+    """
+    if any(c != int(c) for c in src_color):
+        return image # no pixel can be of that color
+    dst_color = [ int(c) for c in dst_color ]
+    bands = image.split()
+    # Mask with the pixels matching the source color in all three bands:
+    mask = None
+    for band, c in zip(bands, src_color):
+        band = band.point([ 255 if v == c else 0 for v in xrange(256) ])
+        mask = band if mask is None else ImageChops.darker(mask, band)
+    recolored = Image.merge('RGBA', [ Image.new('L', image.size, c) for c in dst_color ] + [ bands[3] ])
+    return Image.composite(recolored, image, mask)
+
+def _find_node(root, w, h):
+    """
+    Finds the first free node where a box of the given size fits.
+    """
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if node[4] is not None:
+            stack.append(node[5])
+            stack.append(node[4])
+        elif w <= node[2] and h <= node[3]:
+            return node
+
+def _pack_boxes(boxes):
+    """
+    Packs the boxes, as (width, height), in a rectangle growing it as needed,
+    biggest boxes first (a binary tree bin-packer). Returns the (width,
+    height) of the rectangle and the (x, y) corner of each box.
+    """
+    if not boxes:
+        return (0, 0), []
+    order = sorted(xrange(len(boxes)), key=lambda i: max(boxes[i]), reverse=True)
+    # Nodes are [x, y, width, height, right, down], used once they're split:
+    root = [0, 0, boxes[order[0]][0], boxes[order[0]][1], None, None]
+    corners = [ None ] * len(boxes)
+    for i in order:
+        w, h = boxes[i]
+        node = _find_node(root, w, h)
+        if node is None:
+            # Grow the rectangle, keeping it as square as possible:
+            can_grow_down = w <= root[2]
+            can_grow_right = h <= root[3]
+            if can_grow_right and (root[3] >= root[2] + w or not can_grow_down):
+                root = [0, 0, root[2] + w, root[3], [root[2], 0, w, root[3], None, None], root]
+            else:
+                root = [0, 0, root[2], root[3] + h, root, [0, root[3], root[2], h, None, None]]
+            node = _find_node(root, w, h)
+        node[4] = [node[0] + w, node[1], node[2] - w, h, None, None]
+        node[5] = [node[0], node[1] + h, node[2], node[3] - h, None, None]
+        corners[i] = (node[0], node[1])
+    return (root[2], root[3]), corners
+
 def _sprite_map(g, **kwargs):
     """
     Generates a sprite map from the files matching the glob pattern.
@@ -2275,6 +3248,11 @@ def _sprite_map(g, **kwargs):
         sprite_maps[glob]['*'] = datetime.datetime.now()
     elif '..' not in g: # Protect against going to prohibited places...
         vertical = (kwargs.get('direction', 'vertical') == 'vertical')
+        layout = StringValue(kwargs.get('layout', 'vertical' if vertical else 'horizontal')).value
+        if layout not in ('vertical', 'horizontal', 'diagonal', 'smart'):
+            log.error("Unknown sprite map layout: %s", layout)
+            layout = 'vertical' if vertical else 'horizontal'
+        vertical = (layout == 'vertical')
         offset_x = NumberValue(kwargs.get('offset_x', 0))
         offset_y = NumberValue(kwargs.get('offset_y', 0))
         repeat = StringValue(kwargs.get('repeat', 'no-repeat'))
@@ -2282,7 +3260,7 @@ def _sprite_map(g, **kwargs):
         dst_color = kwargs.get('dst_color')
         src_color = kwargs.get('src_color')
         if position and position > -1 and position < 1:
-            position.units = { '%': _units_weights.get('%', 1), '_': '%' }
+            position = NumberValue._make(position.value, _units_of('%'))
         spacing = kwargs.get('spacing', 0)
         if isinstance(spacing, ListValue):
             spacing = [ int(NumberValue(v).value) for n,v in spacing.items() ]
@@ -2316,11 +3294,23 @@ def _sprite_map(g, **kwargs):
         asset_file = key + '.png'
         asset_path = os.path.join(ASSETS_ROOT, asset_file)
 
-        if os.path.exists(asset_path + '.cache'):
+        if asset_path in _sprite_builds:
+            asset, map, sizes = _sprite_builds[asset_path][1]
+            sprite_maps[asset] = map
+        elif os.path.exists(asset_path + '.cache'):
             asset, map, sizes = pickle.load(open(asset_path + '.cache'))
             sprite_maps[asset] = map
         else:
-            images = tuple( Image.open(storage.open(file)) if storage is not None else Image.open(file) for file, storage in files )
+            # Only the headers are read for the layout, the images are loaded
+            # one at a time while pasting them (so they're not all in memory):
+            sizes = []
+            for file, storage in files:
+                fp = storage.open(file) if storage is not None else open(file, 'rb')
+                try:
+                    sizes.append(Image.open(fp).size)
+                finally:
+                    fp.close()
+            sizes = tuple(sizes)
             names = tuple( os.path.splitext(os.path.basename(file))[0] for file, storage in files )
             positions = []
             spacings = []
@@ -2333,7 +3323,7 @@ def _sprite_map(g, **kwargs):
                 else:
                     _position = NumberValue(_position)
                     if _position and _position > -1 and _position < 1:
-                        _position.units = { '%': _units_weights.get('%', 1), '_': '%' }
+                        _position = NumberValue._make(_position.value, _units_of('%'))
                 positions.append(_position)
                 _spacing = kwargs.get(name + '_spacing')
                 if _spacing is None:
@@ -2354,29 +3344,43 @@ def _sprite_map(g, **kwargs):
                             tot_spacings.append((_spacing[0] + _position, _spacing[1], _spacing[2], _spacing[3]))
                 else:
                     tot_spacings.append(_spacing)
-            sizes = tuple( image.size for image in images )
 
-            _spacings = zip(*tot_spacings)
-            if vertical:
-                width = max(zip(*sizes)[0]) + max(_spacings[1]) + max(_spacings[3])
-                height = sum(zip(*sizes)[1]) + sum(_spacings[0]) + sum(_spacings[2])
+            if layout in ('diagonal', 'smart'):
+                # Each sprite takes a box with its spacing around (positions are ignored):
+                boxes = [ (_spacing[3] + size[0] + _spacing[1], _spacing[0] + size[1] + _spacing[2]) for size, _spacing in zip(sizes, spacings) ]
+                if layout == 'smart':
+                    (width, height), corners = _pack_boxes(boxes)
+                else:
+                    width = sum(w for w, h in boxes)
+                    height = sum(h for w, h in boxes)
+                    corners = []
+                    x = y = 0
+                    for w, h in boxes:
+                        corners.append((x, y))
+                        x += w
+                        y += h
             else:
-                width = sum(zip(*sizes)[0]) + sum(_spacings[1]) + sum(_spacings[3])
-                height = max(zip(*sizes)[1]) + max(_spacings[0]) + max(_spacings[2])
-
-            new_image = Image.new(
-                mode = 'RGBA',
-                size = (width, height),
-                color = (0, 0, 0, 0)
-            )
+                _spacings = zip(*tot_spacings)
+                if vertical:
+                    width = max(zip(*sizes)[0]) + max(_spacings[1]) + max(_spacings[3])
+                    height = sum(zip(*sizes)[1]) + sum(_spacings[0]) + sum(_spacings[2])
+                else:
+                    width = sum(zip(*sizes)[0]) + sum(_spacings[1]) + sum(_spacings[3])
+                    height = max(zip(*sizes)[1]) + max(_spacings[0]) + max(_spacings[2])
 
+            pastes = []
             offsets_x = []
             offsets_y = []
             offset = 0
-            for i, image in enumerate(images):
+            for i, (file, storage) in enumerate(files):
                 spacing = spacings[i]
                 position = positions[i]
-                if vertical:
+                if layout in ('diagonal', 'smart'):
+                    x, y = corners[i]
+                    box = (x + spacing[3], y + spacing[0])
+                    offsets_x.append(x)
+                    offsets_y.append(y)
+                elif vertical:
                     if position and position.unit == '%':
                         x = width * position.value - (spacing[3] + sizes[i][1] + spacing[1])
                     elif position.value < 0:
@@ -2384,7 +3388,7 @@ def _sprite_map(g, **kwargs):
                     else:
                         x = position.value
                     offset += spacing[0]
-                    new_image.paste(image, (int(x + spacing[3]), offset))
+                    box = (int(x + spacing[3]), offset)
                     offsets_x.append(x)
                     offsets_y.append(offset - spacing[0])
                     offset += sizes[i][1] + spacing[2]
@@ -2396,24 +3400,18 @@ def _sprite_map(g, **kwargs):
                     else:
                         y = position.value
                     offset += spacing[3]
-                    new_image.paste(image, (offset, int(y + spacing[0])))
+                    box = (offset, int(y + spacing[0]))
                     offsets_x.append(offset - spacing[3])
                     offsets_y.append(y)
                     offset += sizes[i][0] + spacing[1]
+                pastes.append((file, storage, box))
 
             if dst_color:
                 src_color = ColorValue(src_color).value[:3] if src_color else (0, 0, 0)
                 dst_color = list(ColorValue(dst_color).value[:3])
-                pixdata = new_image.load()
-                for y in xrange(new_image.size[1]):
-                    for x in xrange(new_image.size[0]):
-                        if pixdata[x, y][:3] == src_color:
-                            pixdata[x, y] = tuple(dst_color + [ pixdata[x, y][3] ])
+            else:
+                src_color = None
 
-            try:
-                new_image.save(asset_path)
-            except IOError:
-                log.exception("Error while saving image")
             filetime = int(time.mktime(datetime.datetime.now().timetuple()))
 
             url = '%s%s?_=%s' % (ASSETS_URL, asset_file, filetime)
@@ -2429,7 +3427,16 @@ def _sprite_map(g, **kwargs):
             map['*k*'] = key
             map['*n*'] = map_name
             map['*t*'] = filetime
-            pickle.dump((asset, map, zip(files, sizes)), open(asset_path + '.cache', 'w'))
+            map['*l*'] = layout
+            cache = (asset, map, zip(files, sizes))
+            size = (int(width), int(height))
+            # Everything but the image is known by now, so it can be built in
+            # the background (storages might not be picklable, though):
+            if SPRITE_PROCESSES and all(storage is None for file, storage in files):
+                result = _get_sprite_pool().apply_async(_build_sprite, (asset_path, size, pastes, src_color, dst_color, cache))
+                _sprite_builds[asset_path] = (result, cache)
+            else:
+                _build_sprite(asset_path, size, pastes, src_color, dst_color, cache)
             sprite_maps[asset] = map
         for file, size in sizes:
             sprite_images[file] = size
@@ -2697,13 +3704,7 @@ def _image_url(image, dst_color=None, src_color=None):
             filetime = int(os.path.getmtime(asset_path))
         else:
             image = Image.open(path)
-            image = image.convert("RGBA")
-            pixdata = image.load()
-            for y in xrange(image.size[1]):
-                for x in xrange(image.size[0]):
-                    if pixdata[x, y][:3] == src_color:
-                        new_color = tuple(dst_color + [ pixdata[x, y][3] ])
-                        pixdata[x, y] = new_color
+            image = _recolor(image.convert("RGBA"), src_color, dst_color)
             try:
                 image.save(asset_path)
                 file = asset_file
@@ -2798,9 +3799,11 @@ def __position(opposite, *p):
 def _position(*p):
     return __position(False, *p)
 
+@pure
 def _opposite_position(*p):
     return __position(True, *p)
 
+@pure
 def _grad_point(*p):
     pos = set()
     hrz = vrt = NumberValue(0.5, '%')
@@ -2831,7 +3834,7 @@ def __compass_space_list(*lst):
     Otherwise it returns a new, single element, space-delimited list.
     """
     ret = __compass_list(*lst)
-    ret.value.pop('_', None)
+    ret.separator = ''
     return ret
 
 def _blank(*objs):
@@ -2843,35 +3846,22 @@ def _blank(*objs):
 
 def _compact(*args):
     """Returns a new list after removing any non-true values"""
-    ret = {}
     if len(args) == 1:
         args = args[0]
-        if isinstance(args, ListValue):
-            args = args.value
-        if isinstance(args, dict):
-            for i, item in args.items():
-                if bool(item):
-                    ret[i] = item
-        elif bool(args):
-            ret[0] = args
-    else:
-        for i, item in enumerate(args):
-            if bool(item):
-                ret[i] = item
-    return ListValue(ret)
+        if isinstance(args, (ListValue, dict)):
+            ret = ListValue(args)
+            ret.value = [ item for item in ret.value if bool(item) ]
+            ret.keywords = dict((k, v) for k, v in ret.keywords.items() if bool(v))
+            return ret
+        args = [ args ]
+    return ListValue([ item for item in args if bool(item) ])
 
 def __compass_slice(lst, start_index, end_index=None):
     start_index = NumberValue(start_index).value
     end_index = NumberValue(end_index).value if end_index is not None else None
-    ret = {}
-    lst = ListValue(lst).value
-    for i, item in lst.items():
-        if not isinstance(i, int):
-            if i == '_':
-                ret[i] = item
-        elif i > start_index and end_index is None or i <= end_index:
-            ret[i] = item
-    return ListValue(ret)
+    lst = ListValue(lst)
+    ret = [ item for i, item in enumerate(lst.value) if i > start_index and end_index is None or i <= end_index ]
+    return ListValue(ret, lst.separator)
 
 def _first_value_of(*lst):
     ret = ListValue(lst).first()
@@ -2892,33 +3882,32 @@ def _nth(lst, n=1):
     lst = ListValue(lst).value
     try:
         ret = lst[n]
-    except KeyError:
-        lst = [ v for k,v in sorted(lst.items()) if isinstance(k, int) ]
-        try:
-            ret = lst[n]
-        except:
-            ret = ''
+    except (IndexError, TypeError):
+        ret = ''
     return ret.__class__(ret)
 
 def _join(lst1, lst2, separator=None):
     ret = ListValue(lst1)
-    lst2 = ListValue(lst2).value
-    lst_len = len(ret.value)
-    ret.value.update((k + lst_len if isinstance(k, int) else k, v) for k,v in lst2.items())
+    lst2 = ListValue(lst2)
+    ret.value.extend(lst2.value)
+    ret.keywords.update(lst2.keywords)
+    if lst2.separator:
+        ret.separator = lst2.separator
     if separator is not None:
         separator = StringValue(separator).value
         if separator:
-            ret.value['_'] = separator
+            ret.separator = separator
     return ret
 
 def _length(*lst):
-    lst = ListValue(lst)
-    return NumberValue(len(lst))
+    if len(lst) == 1 and isinstance(lst[0], ListValue):
+        lst = lst[0]
+    return NumberValue(len(ListValue(lst)))
 
 def _append(lst, val, separator=None):
     separator = separator and StringValue(separator).value
     ret = ListValue(lst, separator)
-    ret.value[len(ret)] = val
+    ret.value.append(val)
     return ret
 
 ################################################################################
@@ -2927,7 +3916,7 @@ def _prefixed(prefix, *args):
     to_fnct_str = 'to_' + to_str(prefix).replace('-', '_')
     for arg in args:
         if isinstance(arg, ListValue):
-            for k, iarg in arg.value.items():
+            for iarg in arg.values():
                 if hasattr(iarg, to_fnct_str):
                     return BooleanValue(True)
         else:
@@ -2935,19 +3924,32 @@ def _prefixed(prefix, *args):
                 return BooleanValue(True)
     return BooleanValue(False)
 
+_target_prefixes_cache = {}
+def _target_prefixes(browsers):
+    """
+    Returns the vendor prefixes needed by the browsers in the "browsers"
+    option (names not in `_browser_prefixes` are taken as prefixes).
+    """
+    try:
+        return _target_prefixes_cache[browsers]
+    except KeyError:
+        prefixes = set()
+        for browser in browsers.lower().split():
+            prefixes.update(_browser_prefixes.get(browser, (browser.strip('-_'),)))
+        ret = _target_prefixes_cache[browsers] = frozenset(prefixes)
+        return ret
+
 def _prefix(prefix, *args):
     to_fnct_str = 'to_' + to_str(prefix).replace('-', '_')
     args = list(args)
     for i, arg in enumerate(args):
         if isinstance(arg, ListValue):
-            _value = {}
-            for k, iarg in arg.value.items():
+            _value = ListValue(arg)
+            for j, iarg in enumerate(_value.value):
                 to_fnct = getattr(iarg, to_fnct_str, None)
                 if to_fnct:
-                    _value[k] = to_fnct()
-                else:
-                    _value[k] = iarg
-            args[i] = ListValue(_value)
+                    _value.value[j] = to_fnct()
+            args[i] = _value
         else:
             to_fnct = getattr(arg, to_fnct_str, None)
             if to_fnct:
@@ -2980,13 +3982,48 @@ def __ms(*args):
 def __o(*args):
     return _prefix('_o', *args)
 
+# Prefix functions and the vendor prefix they're for (None if it's an argument):
+_vendor_fncts = {
+    _prefixed: None,
+    _prefix: None,
+    __moz: 'moz',
+    __svg: 'svg',
+    __css2: 'css2',
+    __pie: 'pie',
+    __webkit: 'webkit',
+    __khtml: 'khtml',
+    __ms: 'ms',
+    __o: 'o',
+}
+
+def _skip_prefix(fn, args, browsers):
+    """
+    Calls a prefix function as if the arguments had nothing to say about
+    its vendor prefix, for prefixes none of the target browsers need.
+    Returns None if the call should be done as usual.
+    """
+    prefix = _vendor_fncts[fn]
+    if prefix is None:
+        if not args:
+            return None
+        prefix = to_str(args[0]).strip('-_')
+        args = args[1:]
+    if prefix in _target_prefixes(browsers):
+        return None
+    if fn is _prefixed:
+        return BooleanValue(False)
+    if len(args) == 1:
+        return args[0]
+    return ListValue(args, ',')
+
 ################################################################################
 
+@pure
 def _percentage(value):
     value = NumberValue(value)
-    value.units = { '%': _units_weights.get('%', 1), '_': '%' }
-    return value
+    return NumberValue._make(value.value, _units_of('%'))
 
+@pure
 def _unitless(value):
     value = NumberValue(value)
     return BooleanValue(not bool(value.unit))
@@ -3000,12 +4037,14 @@ def _quote(*args):
 def _pi():
     return NumberValue(math.pi)
 
+@pure
 def _comparable(number1, number2):
     n1, n2 = NumberValue(number1), NumberValue(number2)
     type1 = _conv_type.get(n1.unit)
     type2 = _conv_type.get(n2.unit)
     return BooleanValue(type1 == type2)
 
+@pure
 def _type_of(obj): # -> bool, number, string, color, list
     if isinstance(obj, BooleanValue):
         return StringValue('bool')
@@ -3020,27 +4059,27 @@ def _type_of(obj): # -> bool, number, string, color, list
 def _if(condition, if_true, if_false=''):
     return if_true.__class__(if_true) if bool(condition) else if_true.__class__(if_false)
 
+@pure
 def _unit(number): # -> px, em, cm, etc.
     unit = NumberValue(number).unit
     return StringValue(unit)
 
 __elements_of_type = {
-    'block': dict(enumerate(sorted(['address', 'article', 'aside', 'blockquote', 'center', 'dd', 'dialog', 'dir', 'div', 'dl', 'dt', 'fieldset', 'figure', 'footer', 'form', 'frameset', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hgroup', 'hr', 'isindex', 'menu', 'nav', 'noframes', 'noscript', 'ol', 'p', 'pre', 'section', 'ul']))),
-    'inline': dict(enumerate(sorted(['a', 'abbr', 'acronym', 'b', 'basefont', 'bdo', 'big', 'br', 'cite', 'code', 'dfn', 'em', 'font', 'i', 'img', 'input', 'kbd', 'label', 'q', 's', 'samp', 'select', 'small', 'span', 'strike', 'strong', 'sub', 'sup', 'textarea', 'tt', 'u', 'var']))),
-    'table': dict(enumerate(sorted(['table']))),
-    'list-item': dict(enumerate(sorted(['li']))),
-    'table-row-group': dict(enumerate(sorted(['tbody']))),
-    'table-header-group': dict(enumerate(sorted(['thead']))),
-    'table-footer-group': dict(enumerate(sorted(['tfoot']))),
-    'table-row': dict(enumerate(sorted(['tr']))),
-    'table-cell': dict(enumerate(sorted(['td', 'th']))),
-    'html5': dict(enumerate(sorted(['article', 'aside', 'dialog', 'figure', 'footer', 'header', 'hgroup', 'nav', 'section']))),
+    'block': tuple(sorted(['address', 'article', 'aside', 'blockquote', 'center', 'dd', 'dialog', 'dir', 'div', 'dl', 'dt', 'fieldset', 'figure', 'footer', 'form', 'frameset', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hgroup', 'hr', 'isindex', 'menu', 'nav', 'noframes', 'noscript', 'ol', 'p', 'pre', 'section', 'ul'])),
+    'inline': tuple(sorted(['a', 'abbr', 'acronym', 'b', 'basefont', 'bdo', 'big', 'br', 'cite', 'code', 'dfn', 'em', 'font', 'i', 'img', 'input', 'kbd', 'label', 'q', 's', 'samp', 'select', 'small', 'span', 'strike', 'strong', 'sub', 'sup', 'textarea', 'tt', 'u', 'var'])),
+    'table': tuple(sorted(['table'])),
+    'list-item': tuple(sorted(['li'])),
+    'table-row-group': tuple(sorted(['tbody'])),
+    'table-header-group': tuple(sorted(['thead'])),
+    'table-footer-group': tuple(sorted(['tfoot'])),
+    'table-row': tuple(sorted(['tr'])),
+    'table-cell': tuple(sorted(['td', 'th'])),
+    'html5': tuple(sorted(['article', 'aside', 'dialog', 'figure', 'footer', 'header', 'hgroup', 'nav', 'section'])),
 }
 def _elements_of_type(display):
     d = StringValue(display)
-    ret = __elements_of_type.get(d.value, [])
-    ret['_'] = ','
-    return ListValue(ret)
+    ret = __elements_of_type.get(d.value, ())
+    return ListValue(ret, ',')
 
 def _nest(*arguments):
     ret = [ s.strip() for s in StringValue(arguments[0]).value.split(',') if s.strip() ]
@@ -3053,17 +4092,13 @@ def _nest(*arguments):
                     new_ret.append(r + ' ' + s)
         ret = new_ret
     ret = sorted(set(ret))
-    ret = dict(enumerate(ret))
-    ret['_'] = ','
-    return ret
+    return ListValue(ret, ',')
 
 def _append_selector(selector, to_append):
     selector = StringValue(selector)
     to_append = StringValue(to_append).value.strip()
     ret = sorted(set(s.strip()+to_append for s in selector.value.split(',') if s.strip()))
-    ret = dict(enumerate(ret))
-    ret['_'] = ','
-    return ret
+    return ListValue(ret, ',')
 
 def _headers(frm=None, to=None):
     if frm and to is None:
@@ -3077,9 +4112,7 @@ def _headers(frm=None, to=None):
         frm = 1 if frm is None else int(getattr(frm, 'value', frm))
         to = 6 if to is None else int(getattr(to, 'value', to))
     ret = [ 'h' + str(i) for i in range(frm, to + 1) ]
-    ret = dict(enumerate(ret))
-    ret['_'] = ','
-    return ret
+    return ListValue(ret, ',')
 
 def _enumerate(prefix, frm, through, separator='-'):
     prefix = StringValue(prefix).value
@@ -3090,9 +4123,7 @@ def _enumerate(prefix, frm, through, separator='-'):
         ret = [ prefix + separator + str(i) for i in range(frm, through + 1) ]
     else:
         ret = [ NumberValue(i) for i in range(frm, through + 1) ]
-    ret = dict(enumerate(ret))
-    ret['_'] = ','
-    return ret
+    return ListValue(ret, ',')
 
 def _range(frm, through=None):
     if not through:
@@ -3106,22 +4137,157 @@ def _range(frm, through=None):
 def _convert_to(value, type):
     return value.convert_to(type)
 
+def _op(op, first, second):
+    """
+    Arithmetic operators for the parser. Numbers with the same units (or no
+    units at all) are computed right here; anything else (percentages mixed
+    with other units, colors, strings, lists) goes through the Value classes.
+    """
+    if first.__class__ is NumberValue and second.__class__ is NumberValue:
+        first_units = first.units
+        second_units = second.units
+        if first_units is not second_units and (op is operator.__add__ or op is operator.__sub__):
+            first_unit = _top_weight(first_units)
+            second_unit = _top_weight(second_units)
+            if first_unit != second_unit and (first_unit == '%' or second_unit == '%'):
+                return op(first, second)
+        return NumberValue._make(op(first.value, second.value), _merge_weights(_merge_weights((), first_units), second_units))
+    return op(first, second)
+
+def _units_op(value, type, R):
+    """
+    Units for the parser (as in `10px`); converts numbers right away
+    unless there is a user function with the name of the unit.
+    """
+    if value.__class__ is NumberValue and not (R and R[OPTIONS] and '@function ' + type + ':2' in R[OPTIONS]):
+        return value.convert_to(type)
+    return call(type, ListValue([ value, type ]), R, False)
+
 def _inv(sign, value):
     if isinstance(value, NumberValue):
         return value * -1
     elif isinstance(value, BooleanValue):
         return not value
-    val = StringValue(value)
-    val.value = sign + val.value
-    return val
+    return StringValue(sign + StringValue(value).value)
 
 # pyScss data types:
 
+# Value objects are immutable, so they can be freely shared (constructing a
+# value out of another value of the very same type returns the same object)
+# and the most common ones are cached. Units (for numbers) and types (for
+# colors) are kept in interned weight descriptors: sorted tuples of
+# (name, weight) pairs, shared by all the values using them.
+
+_interned_limit = 1000
+_interned = {}
+_interned_top = {}
+_interned_merges = {}
+_interned_units = {}
+
+def _intern(weights):
+    """
+    Returns the interned weights descriptor for the `weights` dictionary.
+    """
+    desc = tuple(sorted(weights.items()))
+    try:
+        return _interned[desc]
+    except KeyError:
+        if len(_interned) > _interned_limit:
+            _interned.clear()
+        _interned[desc] = desc
+        return desc
+
+def _top_weight(desc):
+    """
+    Returns the name with the most weight in a descriptor (giving more
+    weight to the first unit ever set, for descriptors of units)
+    """
+    try:
+        return _interned_top[desc]
+    except KeyError:
+        pass
+    top = ''
+    if desc:
+        weights = dict(desc)
+        if '_' in weights:
+            _unit = weights.pop('_')
+            weights.setdefault(_unit, 0)
+            weights[_unit] += _units_weights.get(_unit, 1)
+        weights = sorted(weights, key=weights.get)
+        while len(weights):
+            top = weights.pop()
+            if top:
+                break
+    if len(_interned_top) > _interned_limit:
+        _interned_top.clear()
+    _interned_top[desc] = top
+    return top
+
+def _merge_weights(first, second, units=True):
+    """
+    Returns the descriptor resulting of merging the weights of two descriptors.
+    """
+    key = (first, second, units)
+    try:
+        return _interned_merges[key]
+    except KeyError:
+        pass
+    weights = dict(first)
+    for name, val in second:
+        if name != '_':
+            weights.setdefault(name, 0)
+            weights[name] += val
+    if units:
+        unit = _top_weight(second)
+        if _units_weights.get(weights.get('_'), 1) <= _units_weights.get(unit, 1):
+            weights['_'] = unit
+    if len(_interned_merges) > _interned_limit:
+        _interned_merges.clear()
+    ret = _interned_merges[key] = _intern(weights)
+    return ret
+
+def _units_of(type):
+    """
+    Returns the units descriptor for a single unit
+    """
+    try:
+        return _interned_units[type]
+    except KeyError:
+        ret = _interned_units[type] = _intern({ type: _units_weights.get(type, 1), '_': type })
+        return ret
+
 class ParserValue(object):
+    __slots__ = ('value',)
     def __init__(self, value):
         self.value = value
 
+class Thunk(object):
+    """
+    Variable value whose evaluation is delayed until it's first used (the
+    result is then kept). The expression is evaluated against `rule`, whose
+    context is a snapshot of the variables it reads.
+    """
+    __slots__ = ('calculate', 'expr', 'rule', '_value')
+    def __init__(self, calculate, expr, rule):
+        self.calculate = calculate
+        self.expr = expr
+        self.rule = rule
+    @property
+    def value(self):
+        try:
+            return self._value
+        except AttributeError:
+            rule = self.rule
+            self._value = self.calculate(self.expr, rule[CONTEXT], rule[OPTIONS], rule)
+            self.calculate = self.rule = None
+            return self._value
+    def __str__(self):
+        return to_str(self.value)
+    def __repr__(self):
+        return repr(self.value)
+
 class Value(object):
+    __slots__ = ()
     @staticmethod
     def _operatorOperands(tokenlist):
         "generator to extract operators and operands in pairs"
@@ -3153,12 +4319,12 @@ class Value(object):
                         merged = arg.__class__(None)
                     else:
                         merged = Value._merge_type(merged, arg)(None)
-                merged.merge(arg)
+                merged = merged.merge(arg)
                 if isinstance(arg, Value):
                     arg = arg.value
                 _args.append(arg)
-            merged.value = fn(*_args)
-            return merged
+            return merged.replace(fn(*_args))
+        _func.pure = True
         return _func
     @classmethod
     def _do_bitops(cls, first, second, op):
@@ -3217,27 +4383,38 @@ class Value(object):
     def convert_to(self, type):
         return self.value.convert_to(type)
     def merge(self, obj):
-        if isinstance(obj, Value):
-            self.value = obj.value
-        else:
-            self.value = obj
-        return self
+        """
+        Returns a new value of this type holding the value of `obj`
+        (values are immutable; `self` is never modified)
+        """
+        return self.__class__(obj)
+    def replace(self, value):
+        """
+        Returns a new value like this one, but holding `value`
+        """
+        return self.__class__(value)
 
 class BooleanValue(Value):
-    def __init__(self, tokens):
-        self.tokens = tokens
-        if tokens is None:
-            self.value = False
+    __slots__ = ('value',)
+    def __new__(cls, tokens):
+        if tokens.__class__ is BooleanValue:
+            return tokens
+        elif tokens is None:
+            value = False
         elif isinstance(tokens, ParserValue):
-            self.value = (tokens.value.lower() == 'true')
-        elif isinstance(tokens, BooleanValue):
-            self.value = tokens.value
+            value = (tokens.value.lower() == 'true')
         elif isinstance(tokens, NumberValue):
-            self.value = bool(tokens.value)
+            value = bool(tokens.value)
         elif isinstance(tokens, (float, int)):
-            self.value = bool(tokens)
+            value = bool(tokens)
         else:
-            self.value = to_str(tokens).lower() in ('true', '1', 'on', 'yes', 't', 'y') or bool(tokens)
+            value = to_str(tokens).lower() in ('true', '1', 'on', 'yes', 't', 'y') or bool(tokens)
+        return _true if value else _false
+    @classmethod
+    def _make(cls, value):
+        self = object.__new__(cls)
+        self.value = value
+        return self
     def __str__(self):
         return 'true' if self.value else 'false'
     @classmethod
@@ -3255,67 +4432,58 @@ class BooleanValue(Value):
         return op(first, second)
     @classmethod
     def _do_op(cls, first, second, op):
-        if isinstance(first, ListValue) and isinstance(second, ListValue):
-            ret = ListValue(first)
-            for k,v in ret.items():
-                try:
-                    ret.value[k] = op(ret.value[k], second.value[k])
-                except KeyError:
-                    pass
-            return ret
-        if isinstance(first, ListValue):
-            ret = ListValue(first)
-            for k,v in ret.items():
-                ret.value[k] = op(ret.value[k], second)
-            return ret
-        if isinstance(second, ListValue):
-            ret = ListValue(second)
-            for k,v in ret.items():
-                ret.value[k] = op(first, ret.value[k])
-            return ret
+        if isinstance(first, ListValue) or isinstance(second, ListValue):
+            return ListValue._do_op(first, second, op)
 
         first = BooleanValue(first)
         second = BooleanValue(second)
-        val = op(first.value, second.value)
-        ret = BooleanValue(None).merge(first).merge(second)
-        ret.value = val
-        return ret
-    def merge(self, obj):
-        obj = BooleanValue(obj)
-        self.value = obj.value
-        return self
+        return BooleanValue(op(first.value, second.value))
+
+_true = BooleanValue._make(True)
+_false = BooleanValue._make(False)
 
 class NumberValue(Value):
-    def __init__(self, tokens, type=None):
-        self.tokens = tokens
-        self.units = {}
-        if tokens is None:
-            self.value = 0.0
+    __slots__ = ('value', 'units')
+    def __new__(cls, tokens, type=None):
+        units = ()
+        if tokens.__class__ is NumberValue:
+            if tokens.units or type is None:
+                return tokens
+            value = tokens.value
+        elif tokens is None:
+            value = 0.0
         elif isinstance(tokens, ParserValue):
-            self.value = float(tokens.value)
-        elif isinstance(tokens, NumberValue):
-            self.value = tokens.value
-            self.units = tokens.units.copy()
-            if tokens.units:
-                type = None
+            value = float(tokens.value)
         elif isinstance(tokens, (StringValue, basestring)):
             tokens = getattr(tokens, 'value', tokens)
             try:
                 if tokens and tokens[-1] == '%':
-                    self.value = to_float(tokens[:-1]) / 100.0
-                    self.units = { '%': _units_weights.get('%', 1), '_': '%' }
+                    value = to_float(tokens[:-1]) / 100.0
+                    units = _units_of('%')
                 else:
-                    self.value = to_float(tokens)
+                    value = to_float(tokens)
             except ValueError:
                 raise ValueError("Value is not a Number!")
         elif isinstance(tokens, (int, float)):
-            self.value = float(tokens)
+            value = float(tokens)
         else:
             raise ValueError("Value is not a Number!")
         if type is not None:
-            self.units = { type: _units_weights.get(type, 1), '_': type }
+            units = _units_of(type)
+        return cls._make(value, units)
+    @classmethod
+    def _make(cls, value, units=()):
+        if value == 0 or value == 1:
+            try:
+                return _numbers[value, units]
+            except KeyError:
+                pass
+        self = object.__new__(cls)
+        self.value = value
+        self.units = units
+        return self
     def __repr__(self):
-        return '<%s: %s, %s>' % (self.__class__.__name__, repr(self.value), repr(self.units))
+        return '<%s: %s, %s>' % (self.__class__.__name__, repr(self.value), repr(dict(self.units)))
     def __int__(self):
         return int(self.value)
     def __float__(self):
@@ -3340,24 +4508,8 @@ class NumberValue(Value):
             return op(first_type, second_type)
     @classmethod
     def _do_op(cls, first, second, op):
-        if isinstance(first, ListValue) and isinstance(second, ListValue):
-            ret = ListValue(first)
-            for k,v in ret.items():
-                try:
-                    ret.value[k] = op(ret.value[k], second.value[k])
-                except KeyError:
-                    pass
-            return ret
-        if isinstance(first, ListValue):
-            ret = ListValue(first)
-            for k,v in ret.items():
-                ret.value[k] = op(ret.value[k], second)
-            return ret
-        if isinstance(second, ListValue):
-            ret = ListValue(second)
-            for k,v in ret.items():
-                ret.value[k] = op(first, ret.value[k])
-            return ret
+        if isinstance(first, ListValue) or isinstance(second, ListValue):
+            return ListValue._do_op(first, second, op)
 
         if isinstance(first, basestring):
             first = StringValue(first)
@@ -3370,12 +4522,10 @@ class NumberValue(Value):
 
         if op == operator.__mul__:
             if isinstance(first, NumberValue) and isinstance(second, QuotedStringValue):
-                first.value = int(first.value)
-                val = op(second.value, first.value)
+                val = op(second.value, int(first.value))
                 return second.__class__(val)
             if isinstance(first, QuotedStringValue) and isinstance(second, NumberValue):
-                second.value = int(second.value)
-                val = op(first.value, second.value)
+                val = op(first.value, int(second.value))
                 return first.__class__(val)
 
         if not isinstance(first, NumberValue) or not isinstance(second, NumberValue):
@@ -3385,88 +4535,81 @@ class NumberValue(Value):
         second_unit = second.unit
         if op == operator.__add__ or op == operator.__sub__:
             if first_unit == '%' and not second_unit:
-                second.units = { '%': _units_weights.get('%', 1), '_': '%' }
-                second.value /= 100.0
+                second = NumberValue._make(second.value / 100.0, _units_of('%'))
             elif first_unit == '%' and second_unit != '%':
                 first = NumberValue(second) * first.value
             elif second_unit == '%' and not first_unit:
-                first.units = { '%': _units_weights.get('%', 1), '_': '%' }
-                first.value /= 100.0
+                first = NumberValue._make(first.value / 100.0, _units_of('%'))
             elif second_unit == '%' and first_unit != '%':
                 second = NumberValue(first) * second.value
 
         val = op(first.value, second.value)
 
-        ret = NumberValue(None).merge(first)
-        ret = ret.merge(second)
-        ret.value = val
-        return ret
+        units = _merge_weights(_merge_weights((), first.units), second.units)
+        return NumberValue._make(val, units)
     def merge(self, obj):
         obj = NumberValue(obj)
-        self.value = obj.value
-        for unit, val in obj.units.items():
-            if unit != '_':
-                self.units.setdefault(unit, 0)
-                self.units[unit] += val
-        unit = obj.unit
-        if _units_weights.get(self.units.get('_'), 1) <= _units_weights.get(unit, 1):
-            self.units['_'] = unit
-        return self
+        return NumberValue._make(obj.value, _merge_weights(self.units, obj.units))
+    def replace(self, value):
+        return NumberValue._make(value, self.units)
     def convert_to(self, type):
         val = self.value
         if not self.unit:
             val *= _conv_factor.get(type, 1.0)
-        ret = NumberValue(val)
         if type == 'deg':
-            ret.value = ret.value % 360.0
-        ret.units = { type: _units_weights.get(type, 1), '_': type }
-        return ret
+            val = val % 360.0
+        return NumberValue(val, type)
     @property
     def unit(self):
-        unit = ''
-        if self.units:
-            if '_'in self.units:
-                units = self.units.copy()
-                _unit = units.pop('_')
-                units.setdefault(_unit, 0)
-                units[_unit] += _units_weights.get(_unit, 1) # Give more weight to the first unit ever set
-            else:
-                units = self.units
-            units = sorted(units, key=units.get)
-            while len(units):
-                unit = units.pop()
-                if unit:
-                    break
-        return unit
+        return _top_weight(self.units)
+
+_numbers = {}
+for _u in ('', 'px', '%'):
+    for _v in (0.0, 1.0):
+        _units_key = _units_of(_u) if _u else ()
+        _numbers[_v, _units_key] = NumberValue._make(_v, _units_key)
+del _u, _v, _units_key
 
 class ListValue(Value):
+    __slots__ = ('value', 'keywords', 'separator')
     def __init__(self, tokens, separator=None):
-        self.tokens = tokens
+        self.keywords = {}
+        _separator = None
         if tokens is None:
-            self.value = {}
+            self.value = []
         elif isinstance(tokens, ParserValue):
-            self.value = self._reorder_list(tokens.value)
+            # (name, value) pairs, as collected by the parser:
+            self.value = []
+            for n, v in tokens.value:
+                if n is None:
+                    self.value.append(v)
+                else:
+                    self.keywords[n] = v
         elif isinstance(tokens, ListValue):
-            self.value = tokens.value.copy()
+            self.value = list(tokens.value)
+            self.keywords = tokens.keywords.copy()
+            _separator = tokens.separator
         elif isinstance(tokens, Value):
-            self.value = { 0: tokens }
+            self.value = [ tokens ]
         elif isinstance(tokens, dict):
-            self.value = self._reorder_list(tokens)
+            # Old style int-keyed dictionaries ({ 0: a, 1: b, '_': sep }):
+            self.value = [ v for k, v in sorted(tokens.items()) if isinstance(k, int) ]
+            self.keywords = dict((k, v) for k, v in tokens.items() if not isinstance(k, int) and k != '_')
+            _separator = tokens.get('_')
         elif isinstance(tokens, (list, tuple)):
-            self.value = dict(enumerate(tokens))
+            self.value = list(tokens)
         else:
             lst = [ i for i in to_str(tokens).split() if i ]
             if len(lst) == 1:
                 lst = [ i.strip() for i in lst[0].split(',') if i.strip() ]
                 if len(lst) > 1:
-                    separator = ',' if separator is None else separator
+                    _separator = ','
                 else:
                     lst = [ tokens ]
-            self.value = dict(enumerate(lst))
+            self.value = lst
         if separator is None:
-            separator = self.value.pop('_', None)
-        if separator:
-            self.value['_'] = separator
+            separator = _separator
+        self.separator = separator or ''
 
     @classmethod
     def _do_cmps(cls, first, second, op):
@@ -3480,82 +4623,85 @@ class ListValue(Value):
     def _do_op(cls, first, second, op):
         if isinstance(first, ListValue) and isinstance(second, ListValue):
             ret = ListValue(first)
-            for k,v in ret.items():
-                try:
-                    ret.value[k] = op(ret.value[k], second.value[k])
-                except KeyError:
-                    pass
+            for i, v in enumerate(ret.value[:len(second.value)]):
+                ret.value[i] = op(v, second.value[i])
             return ret
         if isinstance(first, ListValue):
             ret = ListValue(first)
-            for k,v in ret.items():
-                ret.value[k] = op(ret.value[k], second)
+            ret.value = [ op(v, second) for v in ret.value ]
             return ret
         if isinstance(second, ListValue):
             ret = ListValue(second)
-            for k,v in ret.items():
-                ret.value[k] = op(first, ret.value[k])
+            ret.value = [ op(first, v) for v in ret.value ]
             return ret
-    def _reorder_list(self, lst):
-        return dict((i if isinstance(k, int) else k, v) for i, (k, v) in enumerate(sorted(lst.items())))
     def __nonzero__(self):
         return len(self)
     def __len__(self):
-        return len(self.value) - (1 if '_' in self.value else 0)
+        return len(self.value) + len(self.keywords)
     def __str__(self):
-        return to_str(self.value)
+        return (self.separator + ' ').join( to_str(v) for v in self.values() )
     def __tuple__(self):
-        return tuple(sorted((k, v) for k, v in self.value.items() if k != '_'))
+        return tuple(self.items())
     def __iter__(self):
         return iter(self.values())
     def values(self):
-        return zip(*self.items())[1]
+        if self.keywords:
+            return tuple(self.value) + tuple(v for k, v in sorted(self.keywords.items()))
+        return tuple(self.value)
     def keys(self):
-        return zip(*self.items())[1]
+        return range(len(self.value)) + sorted(self.keywords)
     def items(self):
-        return sorted((k, v) for k, v in self.value.items() if k != '_')
+        if self.keywords:
+            return list(enumerate(self.value)) + sorted(self.keywords.items())
+        return list(enumerate(self.value))
     def first(self):
-        try:
-            return self.items()[0][1]
-        except IndexError:
-            return None
+        if self.value:
+            return self.value[0]
+        if self.keywords:
+            return self.keywords[min(self.keywords)]
+        return None
 
 class ColorValue(Value):
-    def __init__(self, tokens):
-        self.tokens = tokens
-        self.types = {}
-        self.value = (0, 0, 0, 1)
-        if tokens is None:
-            self.value = (0, 0, 0, 1)
+    __slots__ = ('value', 'types')
+    def __new__(cls, tokens):
+        types = ()
+        value = (0, 0, 0, 1)
+        if tokens.__class__ is ColorValue:
+            return tokens
+        elif tokens is None:
+            pass
         elif isinstance(tokens, ParserValue):
             hex = tokens.value
-            self.value = hex2rgba[len(hex)](hex)
-            self.types = { 'rgba': 1 }
-        elif isinstance(tokens, ColorValue):
-            self.value = tokens.value
-            self.types = tokens.types.copy()
+            try:
+                return _colors_cache[hex]
+            except KeyError:
+                pass
+            if len(_colors_cache) > _interned_limit:
+                _colors_cache.clear()
+            ret = _colors_cache[hex] = cls._make(hex2rgba[len(hex)](hex), _intern({ 'rgba': 1 }))
+            return ret
         elif isinstance(tokens, NumberValue):
             val = tokens.value
-            self.value = (val, val, val, 1)
+            value = (val, val, val, 1)
         elif isinstance(tokens, (list, tuple)):
             c = tokens[:4]
             r = 255.0, 255.0, 255.0, 1.0
             c = [ 0.0 if c[i] < 0 else r[i] if c[i] > r[i] else c[i] for i in range(4) ]
-            self.value = tuple(c)
+            value = tuple(c)
             type = tokens[-1]
             if type in ('rgb', 'rgba', 'hsl', 'hsla'):
-                self.types = { type: 1 }
+                types = _intern({ type: 1 })
         elif isinstance(tokens, (int, float)):
             val = float(tokens)
-            self.value = (val, val, val, 1)
+            value = (val, val, val, 1)
         else:
             hex = to_str(tokens)
             try:
-                self.value = hex2rgba[len(hex)](hex)
+                value = hex2rgba[len(hex)](hex)
             except:
                 try:
                     val = to_float(hex)
-                    self.values = (val, val, val, 1)
+                    value = (val, val, val, 1)
                 except ValueError:
                     try:
                         hex.replace(' ', '').lower()
@@ -3566,8 +4712,8 @@ class ColorValue(Value):
                                 c = [ to_float(c[i]) for i in range(4) ]
                                 col = [ 0.0 if c[i] < 0 else 255.0 if c[i] > 255 else c[i] for i in range(3) ]
                                 col += [ 0.0 if c[3] < 0 else 1.0 if c[3] > 1 else c[3] ]
-                                self.value = tuple(col)
-                                self.types = { type: 1 }
+                                value = tuple(col)
+                                types = _intern({ type: 1 })
                             except:
                                 raise ValueError("Value is not a Color!")
                         elif type in ('hsl', 'hsla'):
@@ -3576,14 +4722,21 @@ class ColorValue(Value):
                                 c = [ to_float(c[i]) for i in range(4) ]
                                 col = [ c[0] % 360.0 ] / 360.0
                                 col += [ 0.0 if c[i] < 0 else 1.0 if c[i] > 1 else c[i] for i in range(1,4) ]
-                                self.value = tuple([ c * 255.0 for c in colorsys.hls_to_rgb(col[0], 0.999999 if col[2] == 1 else col[2], 0.999999 if col[1] == 1 else col[1]) ] + [ col[3] ])
-                                self.types = { type: 1 }
+                                value = tuple([ c * 255.0 for c in colorsys.hls_to_rgb(col[0], 0.999999 if col[2] == 1 else col[2], 0.999999 if col[1] == 1 else col[1]) ] + [ col[3] ])
+                                types = _intern({ type: 1 })
                             except:
                                 raise ValueError("Value is not a Number!")
                     except:
                         raise ValueError("Value is not a Number!")
+        return cls._make(value, types)
+    @classmethod
+    def _make(cls, value, types=()):
+        self = object.__new__(cls)
+        self.value = value
+        self.types = types
+        return self
     def __repr__(self):
-        return '<%s: %s, %s>' % (self.__class__.__name__, repr(self.value), repr(self.types))
+        return '<%s: %s, %s>' % (self.__class__.__name__, repr(self.value), repr(dict(self.types)))
     def __str__(self):
         type = self.type
         c = self.value
@@ -3604,24 +4757,8 @@ class ColorValue(Value):
         return op(first.value, second.value)
     @classmethod
     def _do_op(cls, first, second, op):
-        if isinstance(first, ListValue) and isinstance(second, ListValue):
-            ret = ListValue(first)
-            for k,v in ret.items():
-                try:
-                    ret.value[k] = op(ret.value[k], second.value[k])
-                except KeyError:
-                    pass
-            return ret
-        if isinstance(first, ListValue):
-            ret = ListValue(first)
-            for k,v in ret.items():
-                ret.value[k] = op(ret.value[k], second)
-            return ret
-        if isinstance(second, ListValue):
-            ret = ListValue(second)
-            for k,v in ret.items():
-                ret.value[k] = op(first, ret.value[k])
-            return ret
+        if isinstance(first, ListValue) or isinstance(second, ListValue):
+            return ListValue._do_op(first, second, op)
 
         first = ColorValue(first)
         second = ColorValue(second)
@@ -3630,43 +4767,41 @@ class ColorValue(Value):
         c = val
         r = 255.0, 255.0, 255.0, 1.0
         c = [ 0.0 if c[i] < 0 else r[i] if c[i] > r[i] else c[i] for i in range(4) ]
-        ret = ColorValue(None).merge(first).merge(second)
-        ret.value = tuple(c)
-        return ret
+        types = _merge_weights(_merge_weights((), first.types, False), second.types, False)
+        return ColorValue._make(tuple(c), types)
     def merge(self, obj):
         obj = ColorValue(obj)
-        self.value = obj.value
-        for type, val in obj.types.items():
-            self.types.setdefault(type, 0)
-            self.types[type] += val
-        return self
+        return ColorValue._make(obj.value, _merge_weights(self.types, obj.types, False))
+    def replace(self, value):
+        return ColorValue._make(value, self.types)
     def convert_to(self, type):
-        val = self.value
-        ret = ColorValue(val)
-        ret.types[type] = 1
-        return ret
+        val = ColorValue(self.value).value
+        return ColorValue._make(val, _intern({ type: 1 }))
     @property
     def type(self):
-        type = ''
-        if self.types:
-            types = sorted(self.types, key=self.types.get)
-            while len(types):
-                type = types.pop()
-                if type:
-                    break
-        return type
+        return _top_weight(self.types)
+
+_colors_cache = {}
 
 class QuotedStringValue(Value):
-    def __init__(self, tokens):
-        self.tokens = tokens
-        if tokens is None:
-            self.value = ''
+    __slots__ = ('value',)
+    def __new__(cls, tokens):
+        if tokens.__class__ is cls:
+            return tokens
+        elif tokens is None:
+            value = ''
         elif isinstance(tokens, ParserValue):
-            self.value = dequote(tokens.value)
+            value = dequote(tokens.value)
         elif isinstance(tokens, QuotedStringValue):
-            self.value = tokens.value
+            value = tokens.value
         else:
-            self.value = to_str(tokens)
+            value = to_str(tokens)
+        return cls._make(value)
+    @classmethod
+    def _make(cls, value):
+        self = object.__new__(cls)
+        self.value = value
+        return self
     def convert_to(self, type):
         return QuotedStringValue(self.value + type)
     def __str__(self):
@@ -3678,24 +4813,8 @@ class QuotedStringValue(Value):
         return op(first.value, second.value)
     @classmethod
     def _do_op(cls, first, second, op):
-        if isinstance(first, ListValue) and isinstance(second, ListValue):
-            ret = ListValue(first)
-            for k,v in ret.items():
-                try:
-                    ret.value[k] = op(ret.value[k], second.value[k])
-                except KeyError:
-                    pass
-            return ret
-        if isinstance(first, ListValue):
-            ret = ListValue(first)
-            for k,v in ret.items():
-                ret.value[k] = op(ret.value[k], second)
-            return ret
-        if isinstance(second, ListValue):
-            ret = ListValue(second)
-            for k,v in ret.items():
-                ret.value[k] = op(first, ret.value[k])
-            return ret
+        if isinstance(first, ListValue) or isinstance(second, ListValue):
+            return ListValue._do_op(first, second, op)
 
         first = QuotedStringValue(first)
         first_value = first.value
@@ -3706,15 +4825,10 @@ class QuotedStringValue(Value):
             second = QuotedStringValue(second)
             second_value = second.value
         val = op(first_value, second_value)
-        ret = QuotedStringValue(None).merge(first).merge(second)
-        ret.value = val
-        return ret
-    def merge(self, obj):
-        obj = QuotedStringValue(obj)
-        self.value = obj.value
-        return self
+        return QuotedStringValue._make(val)
 
 class StringValue(QuotedStringValue):
+    __slots__ = ()
     def __str__(self):
         return self.value
     def __add__(self, other):
@@ -3738,6 +4852,14 @@ class StringValue(QuotedStringValue):
             return string_class(other.value + '+' + self.value)
         return string_class(other.value + self.value)
 
+class PrefixedStringValue(StringValue):
+    """
+    String value which also knows how to render itself for other
+    vendors, through its `to__<prefix>` functions (see `_prefix()`)
+    """
+    __slots__ = ('to__moz', 'to__pie', 'to__ms', 'to__o', 'to__khtml', 'to__css2', 'to__webkit', 'to__svg')
+
+
 # Parser/functions map:
 fnct = {
     'grid-image:4': _grid_image,
@@ -3884,20 +5006,81 @@ for u in _units:
 
 def interpolate(v, R):
     C, O = R[CONTEXT], R[OPTIONS]
+    if isinstance(v, Thunk):
+        v = v.value
     vi = C.get(v, v)
+    if isinstance(vi, Thunk):
+        vi = vi.value
     if v != vi and isinstance(vi, basestring):
         _vi = eval_expr(vi, R, True)
         if _vi is not None:
             vi = _vi
     return vi
 
+_fnct_cache_size = 1000
+_fnct_cache = OrderedDict()
+_calculations_size = 10000
+
+_pure_fncts = {}
+def _pure_fnct(name):
+    """
+    Checks if all the library functions called `name` are pure (plain CSS
+    functions, with no library function, are).
+    """
+    try:
+        return _pure_fncts[name]
+    except KeyError:
+        prefix = name.replace('_', '-') + ':'
+        ret = _pure_fncts[name] = all(getattr(f, 'pure', False) for k, f in fnct.items() if k.startswith(prefix))
+        return ret
+
+def _value_key(value):
+    """
+    Returns a hashable key normalizing the given value (raises TypeError
+    for values which can't be used as keys).
+    """
+    cls = value.__class__
+    if cls is NumberValue:
+        return cls, value.value, value.units
+    elif cls is ColorValue:
+        return cls, value.value, value.types
+    elif cls is ListValue:
+        return cls, value.separator, tuple(_value_key(v) for v in value.value), tuple(sorted((k, _value_key(v)) for k, v in value.keywords.items()))
+    elif cls is PrefixedStringValue:
+        raise TypeError("Prefixed strings can't be used as keys")
+    elif isinstance(value, Value):
+        return cls, value.value
+    hash(value)
+    return cls, value
+
+def _call_pure(fn, args, kwargs):
+    """
+    Calls a pure library function, memoizing its results in a bounded LRU
+    cache keyed by the function and its normalized arguments.
+    """
+    try:
+        key = fn, tuple(_value_key(a) for a in args), tuple(sorted((k, _value_key(v)) for k, v in kwargs.items()))
+    except TypeError:
+        return fn(*args, **kwargs)
+    try:
+        node = _fnct_cache.pop(key)
+    except KeyError:
+        node = fn(*args, **kwargs)
+        if len(_fnct_cache) >= _fnct_cache_size:
+            _fnct_cache.popitem(False)
+    _fnct_cache[key] = node
+    if isinstance(node, ListValue):
+        # Lists are mutable, don't hand out the cached one:
+        node = ListValue(node)
+    return node
+
 def call(name, args, R, is_function=True):
     C, O = R[CONTEXT], R[OPTIONS]
     # Function call:
     _name = name.replace('_', '-')
-    s = args and args.value.items() or []
-    _args = [ v for n,v in s if isinstance(n, int) ]
-    _kwargs = dict( (str(n[1:]).replace('-', '_'), v) for n,v in s if not isinstance(n, int) and n != '_' )
+    s = args and args.items() or []
+    _args = args and args.value or []
+    _kwargs = args and dict( (str(n[1:]).replace('-', '_'), v) for n,v in args.keywords.items() ) or {}
     _fn_a = '%s:%d' % (_name, len(_args))
     #print >>sys.stderr, '#', _fn_a, _args, _kwargs
     _fn_n = '%s:n' % _name
@@ -3907,27 +5090,30 @@ def call(name, args, R, is_function=True):
             node = fn(R, *_args, **_kwargs)
         else:
             fn = fnct.get(_fn_a) or fnct[_fn_n]
-            node = fn(*_args, **_kwargs)
-        if args and isinstance(node, ListValue):
-            separator = args.value.get('_')
-            if separator is not None:
-                if separator:
-                    node.value['_'] = separator
-                else:
-                    node.value.pop('_', None)
+            node = None
+            if O and O.get('browsers') and fn in _vendor_fncts:
+                node = _skip_prefix(fn, _args, O['browsers'])
+            if node is not None:
+                pass
+            elif getattr(fn, 'pure', False):
+                node = _call_pure(fn, _args, _kwargs)
+            else:
+                node = fn(*_args, **_kwargs)
+        if args and isinstance(node, ListValue) and args.separator:
+            node.separator = args.separator
     except KeyError:
-        sp = args and args.value.get('_') or ''
+        sp = args and args.separator or ''
         if is_function:
             if _name not in _KNOWN_FUNCTIONS:
                 log.error("Required function not found (\"%s\"): %s", R[FILE], _fn_a)
             _args = (sp + ' ').join( to_str(v) for n,v in s if isinstance(n, int) )
-            _kwargs = (sp + ' ').join( '%s: %s' % (n, to_str(v)) for n,v in s if not isinstance(n, int) and n != '_' )
+            _kwargs = (sp + ' ').join( '%s: %s' % (n, to_str(v)) for n,v in s if not isinstance(n, int) )
             if _args and _kwargs:
                 _args += (sp + ' ')
             # Function not found, simply write it as a string:
             node = StringValue(name + '(' + _args + _kwargs + ')')
         else:
-            node = StringValue((sp + ' ').join( str(v) for n,v in s if n != '_' ))
+            node = StringValue((sp + ' ').join( str(v) for n,v in s ))
     return node
 
 ################################################################################
@@ -4212,11 +5398,11 @@ class Calculator(Parser):
             if _token_ == 'ADD':
                 ADD = self._scan('ADD')
                 m_expr = self.m_expr(R)
-                v = v + m_expr
+                v = _op(operator.__add__, v, m_expr)
             else:# == 'SUB'
                 SUB = self._scan('SUB')
                 m_expr = self.m_expr(R)
-                v = v - m_expr
+                v = _op(operator.__sub__, v, m_expr)
         return v
 
     def m_expr(self, R):
@@ -4227,11 +5413,11 @@ class Calculator(Parser):
             if _token_ == 'MUL':
                 MUL = self._scan('MUL')
                 u_expr = self.u_expr(R)
-                v = v * u_expr
+                v = _op(operator.__mul__, v, u_expr)
             else:# == 'DIV'
                 DIV = self._scan('DIV')
                 u_expr = self.u_expr(R)
-                v = v / u_expr
+                v = _op(operator.__div__, v, u_expr)
         return v
 
     def u_expr(self, R):
@@ -4249,7 +5435,7 @@ class Calculator(Parser):
             v = atom
             if self._peek(self.u_expr_rsts_) == 'UNITS':
                 UNITS = self._scan('UNITS')
-                v = call(UNITS, ListValue(ParserValue({ 0: v, 1: UNITS })), R, False)
+                v = _units_op(v, UNITS, R)
             return v
 
     def atom(self, R):
@@ -4291,7 +5477,7 @@ class Calculator(Parser):
             return interpolate(VAR, R)
 
     def expr_lst(self, R):
-        n = None
+        n = sep = None
         if self._peek(self.expr_lst_rsts) == 'VAR':
             VAR = self._scan('VAR')
             if self._peek(self.expr_lst_rsts_) == '":"':
@@ -4299,11 +5485,11 @@ class Calculator(Parser):
                 n = VAR
             else: self._rewind()
         expr_slst = self.expr_slst(R)
-        v = { n or 0: expr_slst }
+        v = [(n, expr_slst)]
         while self._peek(self.expr_lst_rsts__) == 'COMMA':
             n = None
             COMMA = self._scan('COMMA')
-            v['_'] = COMMA
+            sep = COMMA
             if self._peek(self.expr_lst_rsts) == 'VAR':
                 VAR = self._scan('VAR')
                 if self._peek(self.expr_lst_rsts_) == '":"':
@@ -4311,16 +5497,16 @@ class Calculator(Parser):
                     n = VAR
                 else: self._rewind()
             expr_slst = self.expr_slst(R)
-            v[n or len(v)] = expr_slst
-        return ListValue(ParserValue(v))
+            v.append((n, expr_slst))
+        return ListValue(ParserValue(v), sep)
 
     def expr_slst(self, R):
         expr = self.expr(R)
-        v = { 0: expr }
+        v = [expr]
         while self._peek(self.expr_slst_rsts) not in self.expr_lst_rsts__:
             expr = self.expr(R)
-            v[len(v)] = expr
-        return ListValue(ParserValue(v)) if len(v) > 1 else v[0]
+            v.append(expr)
+        return ListValue(v) if len(v) > 1 else v[0]
 
     not_test_rsts_ = set(['AND', 'LPAR', 'QSTR', 'END', 'COLOR', 'INV', 'SIGN', 'VAR', 'ADD', 'NUM', 'COMMA', 'FNCT', 'STR', 'NOT', 'BOOL', 'ID', 'RPAR', 'OR'])
     m_expr_chks = set(['MUL', 'DIV'])
@@ -4967,6 +6153,41 @@ Multiple Extends
     border-width: 3px;
 }
 
+Selectors made redundant by an extend are dropped (only from the rules
+the extends changed, hand written selectors are left as they are)
+>>> print css.compile('''
+... @option compress:no, short_colors:yes, reverse_colors:yes;
+... .list .item, .list > .active {
+...   color: red;
+... }
+... .active {
+...   @extend .item;
+... }
+... .p .q, .p > .q {
+...   color: blue;
+... }
+... ''') #doctest: +NORMALIZE_WHITESPACE
+.list .active, .list .item {
+    color: red;
+}
+.p .q, .p > .q {
+    color: #00f;
+}
+
+...and the selectors extends can add to a rule are capped (with a warning):
+>>> module = sys.modules[Scss.__module__]
+>>> module._extended_selectors_size, size = 3, module._extended_selectors_size
+>>> print css.compile('''
+... @option compress:yes;
+... .a { x: 1; }
+... .b { @extend .a; }
+... .c { @extend .a; }
+... .d { @extend .a; }
+... ''')
+.a,.b,.c{x:1}
+<BLANKLINE>
+>>> module._extended_selectors_size = size
+
 
 
 FROM THE FORUM
@@ -5290,6 +6511,286 @@ a {
 }
 
 
+>>> base = Scss()
+>>> base.freeze('''
+... @option compress:no, short_colors:yes, reverse_colors:yes;
+... $color: red;
+... @mixin colored { color: $color; }
+... ''')
+>>> print base.compile('''
+... .a { @include colored; }
+... ''') #doctest: +NORMALIZE_WHITESPACE
+.a {
+    color: red;
+}
+
+>>> base.freeze('''
+... @function double($x) { @return $x * 2; }
+... ''')
+>>> print base.compile('''
+... .b { width: double(5px); }
+... ''') #doctest: +NORMALIZE_WHITESPACE
+.b {
+    width: 10px;
+}
+
+
+Plain CSS still gets its functions and arithmetic evaluated:
+>>> print Scss().compile('''
+... .a { color: darken(red, 10%); width: 10px * 2; c: percentage(0.25) }
+... .b { margin: 1px -2px; height: 1px + 1px; background: url(a+b.png) }
+... ''')
+.a{color:#c00;width:20px;c:25%}.b{margin:1px -2px;height:2px;background:url(a+b.png)}
+<BLANKLINE>
+
+
+>>> themes = Scss()
+>>> for result in themes.compile_variants('''
+... @option compress:no, short_colors:yes, reverse_colors:yes;
+... $brand: red !default;
+... .a { color: $brand; width: 10px * 2; }
+... ''', [{ '$brand': 'navy' }, { '$brand': 'green' }]): print result #doctest: +NORMALIZE_WHITESPACE
+.a {
+    color: navy;
+    width: 20px;
+}
+.a {
+    color: green;
+    width: 20px;
+}
+
+
+Memoized results don't outlive what they depend on, i.e. a library function
+replaced by a user function:
+>>> cached = Scss()
+>>> print cached.compile('.a { c: darken(red, 10%); }')
+.a{c:#c00}
+<BLANKLINE>
+>>> print cached.compile('@function darken($c, $p) { @return blue; } .a { c: darken(red, 10%); }')
+.a{c:#00f}
+<BLANKLINE>
+>>> print cached.compile('.a { c: darken(red, 10%); }')
+.a{c:#c00}
+<BLANKLINE>
+
+...user functions redefined or reading globals that changed:
+>>> print cached.compile('@function f($x) { @return $x * 2; } .a { w: f(1px); }')
+.a{w:2px}
+<BLANKLINE>
+>>> print cached.compile('@function f($x) { @return $x * 3; } .a { w: f(1px); }')
+.a{w:3px}
+<BLANKLINE>
+>>> print cached.compile('$k: 2; @function g($x) { @return $x * $k; } .a { w: g(1px); }')
+.a{w:2px}
+<BLANKLINE>
+>>> print cached.compile('$k: 5; @function g($x) { @return $x * $k; } .a { w: g(1px); }')
+.a{w:5px}
+<BLANKLINE>
+
+...mixins redefined, and expansions adding nested rules (which aren't cached):
+>>> print cached.compile('@mixin m { color: red; } .a { @include m; }')
+.a{color:#f00}
+<BLANKLINE>
+>>> print cached.compile('@mixin m { color: blue; } .a { @include m; }')
+.a{color:#00f}
+<BLANKLINE>
+>>> print cached.compile('@mixin n($c) { color: $c; a { color: blue; } } .a { @include n(red); } .b { @include n(red); }')
+.a{color:#f00}.a a{color:#00f}.b{color:#f00}.b a{color:#00f}
+<BLANKLINE>
+
+Variables are only evaluated when used, but with the values their inputs had
+when they were assigned:
+>>> calls = []
+>>> fnct['probe:0'] = pure(lambda: calls.append(1) or NumberValue(2, 'px'))
+>>> print Scss().compile('$x: 1px; $x: probe() !default; $y: probe(); .a { w: $x; }')
+.a{w:1px}
+<BLANKLINE>
+>>> calls
+[]
+>>> print Scss().compile('$y: probe(); .a { w: $y; }')
+.a{w:2px}
+<BLANKLINE>
+>>> calls
+[1]
+>>> del fnct['probe:0'], _pure_fncts['probe']
+>>> print Scss().compile('$a: 1px; $b: $a * 2; $a: 5px; .a { w: $b; h: $a; }')
+.a{w:2px;h:5px}
+<BLANKLINE>
+
+Mixins and functions are prepared on first use, but with the variables they
+had when defined:
+>>> print Scss().compile('$c: red; @mixin m($x: $c) { color: $x; border-color: $c; } $c: blue; .a { @include m; }')
+.a{color:#f00;border-color:#f00}
+<BLANKLINE>
+>>> print Scss().compile('$k: 2; @function g($x) { @return $x * $k; } $k: 5; .a { w: g(1px); }')
+.a{w:2px}
+<BLANKLINE>
+
+
+>>> styles = Scss().compile_styles('''
+... .a { color: red; width: 10px; }
+... ''')
+>>> print styles['compressed']
+.a{color:#f00;width:10px}
+<BLANKLINE>
+>>> print styles['expanded'] #doctest: +NORMALIZE_WHITESPACE
+.a {
+    color: #ff0000;
+    width: 10px;
+}
+
+
+>>> tokens = Scss().compile_variables('''
+... $spacing: 4px;
+... $large-spacing: $spacing * 4;
+... .a { $local: 1px; }
+... ''')
+>>> sorted(tokens)
+['$large-spacing', '$spacing']
+>>> print tokens['$large-spacing']
+16px
+
+
+>>> print Scss().compile('''
+... @option compress_rules: yes;
+... .a { color: red; color: blue; margin: 0.5em; }
+... .b { color: blue; margin: 0.5em; }
+... ''')
+.a,.b{color:#00f;margin:.5em}
+<BLANKLINE>
+
+Rules aren't moved past others setting a shorthand or longhand of their
+properties, nor are vendor specific pseudo selectors merged:
+>>> print Scss().compile('''
+... @option compress_rules: yes;
+... .x { margin-left: 10px; }
+... .y { margin: 0; }
+... .z { margin-left: 10px; }
+... ::selection { color: red; }
+... ::-moz-selection { color: red; }
+... ''')
+.x{margin-left:10px}.y{margin:0}.z{margin-left:10px}::selection{color:#f00}::-moz-selection{color:#f00}
+<BLANKLINE>
+
+At-rules are left alone:
+>>> print Scss().compile('''
+... @option compress_rules: yes;
+... @font-face { font-family: A; src: url(a.eot); src: url(a.woff) format("woff"); }
+... @font-face { font-family: B; src: url(b.woff); }
+... @page { margin: 0; }
+... .a { margin: 0; }
+... ''')
+@font-face{font-family:A;src:url(a.eot);src:url(a.woff) format("woff")}@font-face{font-family:B;src:url(b.woff)}@page{margin:0}.a{margin:0}
+<BLANKLINE>
+
+
+>>> print Scss().compile('''
+... @option compress:no, group_media:yes;
+... .x { @media screen { width: 1px; } }
+... .y { height: 2px; }
+... .z { @media screen { padding: 3px; } }
+... ''') #doctest: +NORMALIZE_WHITESPACE
+@media screen {
+    .x {
+        width: 1px;
+    }
+    .z {
+        padding: 3px;
+    }
+}
+.y {
+    height: 2px;
+}
+
+Rules aren't moved past others setting a shorthand or longhand of their
+properties:
+>>> print Scss().compile('''
+... @option group_media:yes;
+... .x { @media screen { color: red; } }
+... .a { margin: 0; }
+... .a { @media screen { margin-left: 5px; } }
+... ''')
+@media screen{.x{color:#f00}}.a{margin:0}@media screen{.a{margin-left:5px}}
+<BLANKLINE>
+
+
+>>> used = Scss()
+>>> used.use_corpus(inventory=['.nav', 'a'], safelist=['.js-*'])
+>>> print used.compile('''
+... .nav a, .menu a { color: red; }
+... .footer { color: blue; }
+... .js-open { display: block; }
+... ''')
+.nav a{color:#f00}.js-open{display:block}
+<BLANKLINE>
+
+>>> used.use_corpus(inventory=['table', 'tr'])
+>>> print used.compile('table tbody tr { color: red; } ul li { color: blue; }')
+table tbody tr{color:#f00}
+<BLANKLINE>
+
+Template tags in class attributes are understood:
+>>> import os, shutil, tempfile
+>>> tmp = tempfile.mkdtemp()
+>>> open(os.path.join(tmp, 'page.html'), 'w').write('<a class="btn {% if on %}active{% endif %} btn-{{ kind }}">')
+>>> used.use_corpus(paths=[os.path.join(tmp, 'page.html')])
+>>> print used.compile('.btn.active { color: red; } .btn-primary { color: blue; } .endif, .menu { color: green; }')
+.btn.active{color:#f00}.btn-primary{color:#00f}
+<BLANKLINE>
+>>> shutil.rmtree(tmp)
+
+
+>>> print Scss().compile('''
+... @option browsers: firefox;
+... $g: linear-gradient(red, blue);
+... .a {
+...   @if prefixed(-moz, $g) { background: -moz($g); }
+...   @if prefixed(-webkit, $g) { background: -webkit($g); }
+...   background: $g;
+... }
+... ''')
+.a{background:-moz-linear-gradient(red 0%, #00f 100%);background:linear-gradient(red 0%, #00f 100%)}
+<BLANKLINE>
+
+
+With import_once, a partial imported from several scopes is only expanded
+the first time, later imports just bring in its definitions (overriding the
+ones in scope, as importing it again would):
+>>> import os, shutil, tempfile
+>>> tmp = tempfile.mkdtemp()
+>>> open(os.path.join(tmp, '_defs.scss'), 'w').write('$size: 3px; @mixin box { width: $size; }')
+>>> once = Scss(load_paths=[tmp])
+>>> expanded = []
+>>> manage_children = once.manage_children
+>>> once.manage_children = lambda rule, *args: expanded.append(rule[FILE]) or manage_children(rule, *args)
+>>> print once.compile('''
+... @option import_once: yes;
+... $size: 1px;
+... .a { @import "defs"; @include box; }
+... .b { @import "defs"; @include box; padding: $size; }
+... .c { padding: $size; }
+... ''')
+.a{width:3px}.b{width:3px;padding:3px}.c{padding:1px}
+<BLANKLINE>
+>>> expanded.count('defs')
+1
+>>> shutil.rmtree(tmp)
+
+
+The output is the same no matter the hash seed:
+>>> import os, subprocess, sys
+>>> code = '''import scss; print scss.Scss().compile(\"\"\"
+... @option compress:no, verbosity:2;
+... $a: 1px; $b: red;
+... .a { margin: $a; } .b a { color: $b; }
+... .c { @extend .a; @extend .b; @media screen { @media print { x: 1; } } }
+... .d extends .a&.c { y: 2; }
+... \"\"\")'''
+>>> env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+>>> len(set(subprocess.Popen([sys.executable, '-c', code], env=dict(env, PYTHONHASHSEED=seed), stdout=subprocess.PIPE).communicate()[0] for seed in ('0', '1', '2', '3', '4')))
+1
+
+
 >>> print css.compile('''
 ... @option compress:no, short_colors:yes, reverse_colors:yes;
 ... a, button {
@@ -5388,6 +6889,135 @@ a:hover {
   background-image: url(/images/salamander.png);
 }
 
+>>> print css.compile('''
+... @option compress:no, short_colors:yes, reverse_colors:yes;
+... $list: 1px 2px 3px;
+... $names: a, b, c;
+... .lists {
+...     nth: nth($list, 2) nth($names, last);
+...     length: length($list) length($names);
+...     join: join($list, $names);
+...     append: append($names, d);
+... }
+... ''') #doctest: +NORMALIZE_WHITESPACE
+.lists {
+  nth: 2px c;
+  length: 3 3;
+  join: 1px, 2px, 3px, a, b, c;
+  append: a, b, c, d;
+}
+
+
+SPRITE MAPS (these need PIL, they're just True without it)
+--------------------------------------------------------------------------------
+
+Smart layouts pack the sprites (and their spacing) without overlapping:
+>>> import random
+>>> rnd = random.Random(0)
+>>> sizes = [ (rnd.randint(1, 40), rnd.randint(1, 40)) for i in range(50) ]
+>>> spacing = 2
+>>> (width, height), corners = _pack_boxes([ (w + 2 * spacing, h + 2 * spacing) for w, h in sizes ])
+>>> sprites = [ (x + spacing, y + spacing, w, h) for (x, y), (w, h) in zip(corners, sizes) ]
+>>> all(spacing <= x and x + w + spacing <= width and spacing <= y and y + h + spacing <= height for x, y, w, h in sprites)
+True
+>>> all(x1 + w1 + 2 * spacing <= x2 or x2 + w2 + 2 * spacing <= x1 or y1 + h1 + 2 * spacing <= y2 or y2 + h2 + 2 * spacing <= y1 for i, (x1, y1, w1, h1) in enumerate(sprites) for x2, y2, w2, h2 in sprites[i + 1:])
+True
+
+>>> module = sys.modules[Scss.__module__]
+>>> def make_sprites(count=6):
+...     tmp = tempfile.mkdtemp()
+...     os.makedirs(os.path.join(tmp, 'icons'))
+...     os.makedirs(os.path.join(tmp, 'assets'))
+...     for i in range(count):
+...         Image.new('RGBA', (4 + 5 * i, 30 - 4 * i), (40 * i, 0, 0, 255)).save(os.path.join(tmp, 'icons', 'i%d.png' % i))
+...     module.STATIC_ROOT = tmp + '/'
+...     module.ASSETS_ROOT = os.path.join(tmp, 'assets') + '/'
+...     return tmp
+>>> static_root, assets_root = module.STATIC_ROOT, module.ASSETS_ROOT
+
+Each layout gets its own map, which records it:
+>>> def sprite_layouts():
+...     tmp = make_sprites()
+...     try:
+...         maps = [ sprite_maps[_sprite_map('icons/*.png', layout=layout).value] for layout in ('vertical', 'smart', 'diagonal') ]
+...         return [ m['*l*'] for m in maps ], len(set(m['*f*'] for m in maps))
+...     finally:
+...         shutil.rmtree(tmp)
+>>> Image is None or sprite_layouts() == (['vertical', 'smart', 'diagonal'], 3)
+True
+
+Recoloring gives the same pixels (alpha included) as going pixel by pixel:
+>>> def recolor_matches_loop():
+...     image = Image.new('RGBA', (8, 8), (0, 0, 0, 0))
+...     pixels = image.load()
+...     for i in range(64):
+...         pixels[i % 8, i // 8] = ((0, 0, 0), (10, 20, 30), (10, 20, 31))[i % 3] + (i * 4,)
+...     expected = image.copy()
+...     pixels = expected.load()
+...     for y in xrange(8):
+...         for x in xrange(8):
+...             if pixels[x, y][:3] == (10, 20, 30):
+...                 pixels[x, y] = (255, 0, 128, pixels[x, y][3])
+...     got = _recolor(image, (10, 20, 30), [255, 0, 128])
+...     return list(got.getdata()) == list(expected.getdata()) != list(image.getdata())
+>>> Image is None or recolor_matches_loop()
+True
+
+Sprite sizes come from the image headers, and sprites are stacked as always:
+>>> def sprite_sizes_and_offsets():
+...     tmp = make_sprites()
+...     try:
+...         sprite_map = sprite_maps[_sprite_map('icons/*.png', spacing=1).value]
+...         names = sorted(n for n in sprite_map if not n.startswith('*'))
+...         sizes = [ Image.open(os.path.join(tmp, 'icons', n + '.png')).size for n in names ]
+...         offsets = [ (0, sum(h + 2 for w, h in sizes[:i])) for i in range(len(sizes)) ]
+...         return [ sprite_map[n][0] for n in names ] == sizes and [ sprite_map[n][2:] for n in names ] == offsets
+...     finally:
+...         shutil.rmtree(tmp)
+>>> Image is None or sprite_sizes_and_offsets()
+True
+
+Sprite images can be built by a pool of processes:
+>>> def sprite_processes():
+...     tmp = make_sprites()
+...     module.SPRITE_PROCESSES = 2
+...     try:
+...         Scss().compile('$m: sprite-map("icons/*.png"); .a { background: $m; }')
+...         pool = module._sprite_pool
+...         asset_file = [ f for f in os.listdir(os.path.join(tmp, 'assets')) if f.endswith('.png') ]
+...         asset_path = os.path.join(tmp, 'assets', asset_file[0])
+...         close_sprite_pool()
+...         return pool is not None and len(asset_file) == 1 and os.path.exists(asset_path + '.cache') and Image.open(asset_path).size
+...     finally:
+...         module.SPRITE_PROCESSES = 0
+...         shutil.rmtree(tmp)
+>>> Image is None or sprite_processes() == (29, 30 + 26 + 22 + 18 + 14 + 10)
+True
+
+>>> module.STATIC_ROOT, module.ASSETS_ROOT = static_root, assets_root
+
+
+OUTPUT FILES
+--------------------------------------------------------------------------------
+Writing the same CSS again leaves the files (and their gzipped copies, which
+are always the same bytes) alone:
+>>> tmp = tempfile.mkdtemp()
+>>> out = os.path.join(tmp, 'out.css')
+>>> write_output(out, '.a{color:red}', compress=True)
+>>> gz = open(out + '.gz', 'rb').read()
+>>> for path in (out, out + '.gz'): os.utime(path, (0, 0))
+>>> write_output(out, '.a{color:red}', compress=True)
+>>> os.path.getmtime(out), os.path.getmtime(out + '.gz')
+(0.0, 0.0)
+>>> os.remove(out + '.gz')
+>>> write_output(out, '.a{color:red}', compress=True)
+>>> open(out + '.gz', 'rb').read() == gz
+True
+>>> write_output(out, '.a{color:blue}', compress=True)
+>>> os.path.getmtime(out) > 0, os.path.getmtime(out + '.gz') > 0
+(True, True)
+>>> shutil.rmtree(tmp)
+
 TESTS FOR REPORTED ISSUES:
 --------------------------------------------------------------------------------
 
@@ -5544,6 +7174,43 @@ Sass generates only selectors that are likely to be useful.
 --------------------------------------------------------------------------------
 """
 
+def _write_if_changed(path, content):
+    """
+    Writes the content to the file, unless it already has it (so unchanged
+    files keep their modification times). Returns True if it was written.
+    """
+    try:
+        if hashlib.md5(open(path, 'rb').read()).digest() == hashlib.md5(content).digest():
+            return False
+    except IOError:
+        pass
+    output = open(path, 'wb')
+    try:
+        output.write(content)
+    finally:
+        output.close()
+    return True
+
+def write_output(path, content, compress=False):
+    """
+    Writes the compiled CSS to the given path and, if `compress`, also a
+    precompressed `path + '.gz'` (at maximum compression), to be served as
+    is. Files are only written if their content changed.
+    """
+    _write_if_changed(path, content)
+    if compress:
+        import gzip
+        buf = StringIO.StringIO()
+        # No file name or time stamp, so the same CSS gives the same bytes:
+        gz = gzip.GzipFile(filename='', mode='wb', compresslevel=9, fileobj=buf, mtime=0)
+        try:
+            gz.write(content)
+        finally:
+            gz.close()
+        gz_content = buf.getvalue()
+        _write_if_changed(path + '.gz', gz_content)
+        print >>sys.stderr, '%s: %d bytes (%d bytes gzipped)' % (path, len(content), len(gz_content))
+
 def main():
     from optparse import OptionGroup, OptionParser, SUPPRESS_HELP
 
@@ -5556,6 +7223,15 @@ def main():
                       help="Write output to FILE")
     parser.add_option("--time", action="store_true",
                       help="Display compliation times")
+    parser.add_option("-z", "--gzip", action="store_true",
+                      help="Also write a gzipped copy of the output FILE (as FILE.gz)")
+    parser.add_option("--used-in", metavar="FILE", action="append", dest="used_in",
+                      help="Leave out the rules that can't match anything in the HTML or "
+                           "template FILE, may be given multiple times")
+    parser.add_option("--safelist", metavar="NAME", action="append",
+                      help="Keep the rules using NAME (a class as in .name, an id as in "
+                           "#name or a tag, glob patterns allowed) with --used-in, may be "
+                           "given multiple times")
     parser.add_option("-t", "--test", action="store_true", help=SUPPRESS_HELP)
     parser.add_option("-?", action="help", help=SUPPRESS_HELP)
     parser.add_option("-h", "--help", action="help",
@@ -5571,12 +7247,14 @@ def main():
                       help="Static root path (Where images and static resources are located)")
     paths_group.add_option("-A", "--assets-root", metavar="PATH", dest="assets_root",
                       help="Assets root path (Sprite images will be created here)")
+    paths_group.add_option("--sprite-processes", metavar="N", type="int", dest="sprite_processes",
+                      help="Build sprite images in N processes in parallel")
     parser.add_option_group(paths_group)
 
     (options, args) = parser.parse_args()
 
     # General runtime configuration
-    global VERBOSITY, STATIC_ROOT, ASSETS_ROOT
+    global VERBOSITY, STATIC_ROOT, ASSETS_ROOT, SPRITE_PROCESSES
     VERBOSITY = 0
 
     if options.time:
@@ -5585,6 +7263,8 @@ def main():
         STATIC_ROOT = options.static_root
     if options.assets_root is not None:
         ASSETS_ROOT = options.assets_root
+    if options.sprite_processes is not None:
+        SPRITE_PROCESSES = options.sprite_processes
 
     # Execution modes
     if options.test:
@@ -5685,7 +7365,7 @@ def main():
                                 d = dict((k, v) for k, v in options.items() if k.startswith('@' + name + ' ') and code in k)
                                 seen = set()
                                 for k, mixin in d.items():
-                                    mixin = getattr(mixin, 'mixin', mixin)
+                                    mixin = css._prepare_mixin(getattr(mixin, 'mixin', mixin))
                                     fn_name, _, _ = k.partition(':')
                                     if fn_name not in seen:
                                         seen.add(fn_name)
@@ -5706,18 +7386,21 @@ def main():
                 print s
         print 'Bye!'
     else:
-        if options.output is not None:
-            output = open(options.output, 'wt')
-        else:
-            output = sys.stdout
-
         css = Scss(load_paths=options.load_paths)
+        if options.used_in:
+            css.use_corpus(options.used_in, safelist=options.safelist or ())
         if args:
+            output = ''
             for path in args:
                 finput = open(path, 'rt')
-                output.write(css.compile(finput.read()))
+                output += css.compile(finput.read())
+        else:
+            output = css.compile(sys.stdin.read())
+
+        if options.output is not None:
+            write_output(options.output, output, options.gzip)
         else:
-            output.write(css.compile(sys.stdin.read()))
+            sys.stdout.write(output)
 
         for f, t in profiling.items():
             print >>sys.stderr, '%s took %03fs' % (f, t)